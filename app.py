@@ -1,12 +1,31 @@
 import os
 import random
 import json
+import time
+import hashlib
+import hmac
+import threading
+import sqlite3
+import gzip
+import urllib.parse
+import urllib.request
 import gspread
+import httpx
 from google import genai
-from flask import Flask, jsonify, request
+from google.genai import types as genai_types
+from flask import Flask, Response, g, jsonify, request, send_from_directory, stream_with_context
 from flask_cors import CORS
 from dotenv import load_dotenv
 import re
+import logging
+import math
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+try:
+    import brotli # Необязательная зависимость: без неё ответы сжимаются только gzip
+except ImportError:
+    brotli = None
 
 # --- Инициализация и настройка ---
 load_dotenv()
@@ -24,54 +43,86 @@ CORS(app, resources={r"/*": {"origins": origins}})
 client = None  # <-- ИСПРАВЛЕНО: было model
 sh = None
 PLAYLIST_METADATA_SHEET_NAME = "_PlaylistMetadata" # Название мета-листа
-PLAYLIST_METADATA = {} # Словарь для хранения метаданных плейлистов
+PLAYLIST_METADATA = {} # Словарь для хранения метаданных плейлистов (зеркало текущего снимка библиотеки)
+LIBRARY_SNAPSHOT = None # Текущий снимок библиотеки (метаданные + все листы), см. LibrarySnapshot
+LIBRARY_REFRESH_INTERVAL = int(os.getenv('LIBRARY_REFRESH_INTERVAL', '300')) # Период фонового обновления, сек
+LIBRARY_REFRESH_TOKEN = os.getenv('LIBRARY_REFRESH_TOKEN') # Токен ручного обновления; без него /refresh-library выключен
+PROMPT_CACHE_MAX_ENTRIES = int(os.getenv('PROMPT_CACHE_MAX_ENTRIES', '64')) # Лимит кэша фрагментов промптов
+ROUTER_CONFIDENCE_THRESHOLD = float(os.getenv('ROUTER_CONFIDENCE_THRESHOLD', '0.35')) # Ниже этого порога плейлист выбирает Gemini
+SEARCH_STEM_LENGTH = 5 # Сколько первых букв слова учитывать при локальном поиске
+STAGE2_MAX_CANDIDATES = int(os.getenv('STAGE2_MAX_CANDIDATES', '60')) # Сколько треков максимум отправлять в промпт этапа 2
+STAGE2_EXPLORATION_SHARE = float(os.getenv('STAGE2_EXPLORATION_SHARE', '0.25')) # Доля случайных треков среди кандидатов
+STAGE2_MAX_PER_ARTIST = int(os.getenv('STAGE2_MAX_PER_ARTIST', '3')) # Лимит релевантных кандидатов одного исполнителя
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '8')) # Сколько вызовов Gemini одновременно на процесс
+STAGE1_TIMEOUT = float(os.getenv('STAGE1_TIMEOUT', '6')) # Дедлайн этапа 1, сек (включая ожидание свободного слота)
+STAGE2_TIMEOUT = float(os.getenv('STAGE2_TIMEOUT', '30')) # Дедлайн этапа 2, сек
+SHEETS_TIMEOUT = float(os.getenv('SHEETS_TIMEOUT', '30')) # Таймаут HTTP-запросов к Google Sheets, сек
+RADIO_BLOCK_SIZE = 10 # Сколько треков в одном музыкальном блоке
+STAGE2_STRUCTURED_OUTPUT = os.getenv('STAGE2_STRUCTURED_OUTPUT', '1') != '0' # Просить у Gemini JSON по схеме на этапе 2
+LISTENER_NAME_PLACEHOLDER = "[[NAME]]" # Вместо имени в общем промпте этапа 2, имя подставляется после генерации
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', '1800')) # Сколько живут закэшированные решения AI, сек
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', str(8 * 1024 * 1024))) # Лимит памяти кэша ответов
+RESPONSE_CACHE_VARIANTS = int(os.getenv('RESPONSE_CACHE_VARIANTS', '1')) # Сколько разных блоков копить на один запрос
+REQUEST_PLACEHOLDER = "[[REQUEST]]" # Вместо пожелания в промпте блоков для пула, подставляется при выдаче
+BLOCK_POOL_SIZE = int(os.getenv('BLOCK_POOL_SIZE', '2')) # Готовых блоков на (плейлист, язык); 0 — пул выключен
+BLOCK_POOL_MAX_USES = int(os.getenv('BLOCK_POOL_MAX_USES', '1')) # Сколько раз можно выдать один готовый блок
+BLOCK_POOL_LANGUAGES = [code for code in os.getenv('BLOCK_POOL_LANGUAGES', 'ru,en,uk').split(',') if code] # Языки пула
+BLOCK_POOL_REFILL_INTERVAL = float(os.getenv('BLOCK_POOL_REFILL_INTERVAL', '20')) # Пауза между генерациями в фоне, сек
+BLOCK_POOL_IDLE_LOAD = float(os.getenv('BLOCK_POOL_IDLE_LOAD', '0.25')) # Пул пополняется, только пока загрузка Gemini ниже
+BLOCK_POOL_PRESSURE_LOAD = float(os.getenv('BLOCK_POOL_PRESSURE_LOAD', '0.75')) # Выше этой загрузки блоки берутся из пула
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper() # Уровень логгера 'radio'
+PROMPT_LOG_SAMPLE_RATE = float(os.getenv('PROMPT_LOG_SAMPLE_RATE', '0.01')) # Доля промптов, попадающих в лог (уровень DEBUG)
+FULL_PLAYLIST_PAGE_LIMIT = int(os.getenv('FULL_PLAYLIST_PAGE_LIMIT', '1000')) # Максимальный размер страницы /get-full-playlist
+COMPRESSION_MIN_BYTES = int(os.getenv('COMPRESSION_MIN_BYTES', '1024')) # Ответы меньше этого не сжимаются
+ENCODED_CACHE_MAX_BYTES = int(os.getenv('ENCODED_CACHE_MAX_BYTES', str(16 * 1024 * 1024))) # Лимит памяти кэша готовых (сжатых) тел ответов
+LIBRARY_SNAPSHOT_PATH = os.getenv('LIBRARY_SNAPSHOT_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'library_snapshot.sqlite3')) # Локальная копия библиотеки; пусто — не сохранять
+MUSIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'music') # Локальные mp3, отдаются через /audio/
+AUDIO_CACHE_MAX_AGE = int(os.getenv('AUDIO_CACHE_MAX_AGE', str(30 * 24 * 3600))) # Сколько браузер и CDN хранят аудиофайлы, сек
+AUDIO_X_SENDFILE = os.getenv('AUDIO_X_SENDFILE', '0') == '1' # Отдавать файлы через X-Sendfile фронтового nginx/Apache
+AUDIO_FETCH_TIMEOUT = float(os.getenv('AUDIO_FETCH_TIMEOUT', '15')) # Таймаут чтения внешнего music_url для общего потока, сек
+RADIO_STREAM_ENABLED = os.getenv('RADIO_STREAM_ENABLED', '0') == '1' # Включить общий непрерывный поток /radio-stream/<лист>
+RADIO_STREAM_BITRATE = int(os.getenv('RADIO_STREAM_BITRATE', '128')) # Битрейт mp3 в потоке, кбит/с — по нему идёт темп вещания
+RADIO_STREAM_BUFFER_SECONDS = int(os.getenv('RADIO_STREAM_BUFFER_SECONDS', '30')) # Глубина кольцевого буфера станции, сек
+RADIO_STREAM_PREBUFFER_SECONDS = int(os.getenv('RADIO_STREAM_PREBUFFER_SECONDS', '5')) # Сколько из буфера отдаётся сразу при подключении
+RADIO_STREAM_IDLE_TIMEOUT = float(os.getenv('RADIO_STREAM_IDLE_TIMEOUT', '60')) # Станция без слушателей останавливается через, сек
+RADIO_STREAM_CHUNK_BYTES = 4096 # Размер куска mp3 в кольцевом буфере
+app.config['USE_X_SENDFILE'] = AUDIO_X_SENDFILE
 
-# --- Подключение к Google Sheets ---
 try:
-    gcp_credentials_json = os.getenv('GCP_CREDENTIALS')
-    if gcp_credentials_json:
-        credentials_dict = json.loads(gcp_credentials_json)
-        gc = gspread.service_account_from_dict(credentials_dict)
-        print("Успешное подключение к Google Sheets через переменные окружения.")
-    else:
-        gc = gspread.service_account(filename='credentials.json')
-        print("Успешное подключение к Google Sheets через локальный файл.")
+    BUNDLED_MUSIC_FILES = frozenset(os.listdir(MUSIC_DIR)) # Файлы в static/music, для них musicUrl ведёт на /audio/
+except OSError:
+    BUNDLED_MUSIC_FILES = frozenset()
 
-    sh = gc.open_by_key('1NDTPGtwDlqo0djTQlsegZtI8-uTl1ojTtbT0PmtR5YU') # ЗАМЕНИ НА СВОЙ КЛЮЧ
-    print("Успешно получен доступ к таблице.")
-
-    # --- NEW: Загрузка метаданных плейлистов ---
-    def load_playlist_metadata(spreadsheet_obj):
-        global PLAYLIST_METADATA
-        try:
-            metadata_sheet = spreadsheet_obj.worksheet(PLAYLIST_METADATA_SHEET_NAME)
-            records = metadata_sheet.get_all_records()
-            for record in records:
-                # Проверяем, что есть SheetName, чтобы избежать пустых строк
-                if record.get('SheetName'):
-                    PLAYLIST_METADATA[record['SheetName']] = record
-            if PLAYLIST_METADATA:
-                print(f"Метаданные для {len(PLAYLIST_METADATA)} плейлистов успешно загружены.")
-            else:
-                print(f"Предупреждение: Метаданные плейлистов из листа '{PLAYLIST_METADATA_SHEET_NAME}' не загружены или лист пуст.")
-        except gspread.exceptions.WorksheetNotFound:
-            print(f"КРИТИЧЕСКАЯ ОШИБКА: Мета-лист '{PLAYLIST_METADATA_SHEET_NAME}' не найден в таблице.")
-            PLAYLIST_METADATA = {}
-        except Exception as e:
-            print(f"Ошибка при загрузке метаданных плейлистов: {e}")
-            PLAYLIST_METADATA = {}
+# --- Подключение к Google Sheets ---
+def connect_to_sheets():
+    """Подключается к таблице и сохраняет её в sh. Вызывается лениво из обновления библиотеки,
+    поэтому недоступность Google Sheets не блокирует старт, а неудачная попытка повторится позже."""
+    global sh
+    try:
+        gcp_credentials_json = os.getenv('GCP_CREDENTIALS')
+        if gcp_credentials_json:
+            credentials_dict = json.loads(gcp_credentials_json)
+            gc = gspread.service_account_from_dict(credentials_dict)
+            print("Успешное подключение к Google Sheets через переменные окружения.")
+        else:
+            gc = gspread.service_account(filename='credentials.json')
+            print("Успешное подключение к Google Sheets через локальный файл.")
 
-    load_playlist_metadata(sh) # Загружаем метаданные сразу после подключения
+        gc.set_timeout(SHEETS_TIMEOUT)
+        sh = gc.open_by_key('1NDTPGtwDlqo0djTQlsegZtI8-uTl1ojTtbT0PmtR5YU') # ЗАМЕНИ НА СВОЙ КЛЮЧ
+        print("Успешно получен доступ к таблице.")
 
-except Exception as e:
-    print(f"КРИТИЧЕСКАЯ ОШИБКА ПОДКЛЮЧЕНИЯ К GOOGLE SHEETS ИЛИ ЗАГРУЗКИ МЕТАДАННЫХ: {e}")
-    sh = None
-    PLAYLIST_METADATA = {}
+    except Exception as e:
+        print(f"КРИТИЧЕСКАЯ ОШИБКА ПОДКЛЮЧЕНИЯ К GOOGLE SHEETS: {e}")
+        sh = None
+    return sh
 
 # --- Настройка Gemini API ---
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 if GEMINI_API_KEY:
-    client = genai.Client(api_key=GEMINI_API_KEY)  # <-- ИСПРАВЛЕНО
+    # Запасной таймаут HTTP; вызовы этапов задают свой, по дедлайну этапа (см. deadline_config)
+    client = genai.Client(api_key=GEMINI_API_KEY,
+                          http_options=genai_types.HttpOptions(timeout=int((STAGE2_TIMEOUT + 5) * 1000)))
     print("Успешная настройка Gemini API с моделью gemini-2.5-flash")
 else:
     print("КРИТИЧЕСКАЯ ОШИБКА: API ключ для Gemini не найден.")
@@ -98,7 +149,9 @@ PROMPT_TEMPLATES = {
 {{
   "playlist": ["ID_трека_1", "ID_трека_2"],
   "speechText": "Текст твоей живой и интересной подводки здесь."
-}}"""
+}}""",
+        'fallback_speech': """{user_name}, по запросу "{user_request}" ставлю подборку из плейлиста '{selected_sheet_name}'. Приятного прослушивания!""",
+        'default_request': "удиви меня"
     },
     'en': {
         'stage1': """You are a music manager. Analyze the listener's request and choose ONE, the most suitable playlist from the list below.
@@ -119,7 +172,9 @@ RESPONSE STRUCTURE (JSON only):
 {{
   "playlist": ["track_ID_1", "track_ID_2"],
   "speechText": "Text of your lively and interesting intro here."
-}}"""
+}}""",
+        'fallback_speech': """{user_name}, for your request "{user_request}" here is a selection from the playlist '{selected_sheet_name}'. Enjoy the music!""",
+        'default_request': "surprise me"
     },
     'uk': {
         'stage1': """Ти — музичний менеджер. Проаналізуй запит слухача та вибери ОДИН, найбільш підходящий плейлист зі списку нижче.
@@ -140,24 +195,165 @@ RESPONSE STRUCTURE (JSON only):
 {{
   "playlist": ["ID_треку_1", "ID_треку_2"],
   "speechText": "Текст твоєї живої та цікавої підводки тут."
-}}"""
+}}""",
+        'fallback_speech': """{user_name}, на запит "{user_request}" вмикаю добірку з плейлиста '{selected_sheet_name}'. Приємного прослуховування!""",
+        'default_request': "здивуй мене"
     }
 }
 
-# --- Вспомогательные функции ---
-def get_all_tracks_from_sheet(worksheet):
-    if not worksheet:
-        print("Ошибка: объект worksheet не предоставлен.")
-        return []
-    try:
-        return worksheet.get_all_records()
-    except Exception as e:
-        print(f"Ошибка при получении записей из Google Sheets '{worksheet.title}': {e}")
-        return []
+# --- Метрики и логирование ---
+logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger('radio')
+logger.setLevel(LOG_LEVEL)
+
+def log_prompt(title, prompt):
+    """Полные промпты большие, поэтому пишем в лог только выборку и только при уровне DEBUG."""
+    if logger.isEnabledFor(logging.DEBUG) and random.random() < PROMPT_LOG_SAMPLE_RATE:
+        logger.debug("--- %s ---\n%s\n----------------------------", title, prompt)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+    """Счётчик в формате Prometheus (значения хранятся в памяти процесса)."""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    """Гистограмма в формате Prometheus с фиксированными границами корзин."""
 
+    def __init__(self, name, documentation, buckets, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self.labelnames = tuple(labelnames)
+        self._values = {} # {метки: [счётчики корзин..., сумма, количество]}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[position] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, state in sorted(self._values.items()):
+                for position, bound in enumerate(self.buckets):
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', bound)])} {state[position]}")
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', '+Inf')])} {state[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {state[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {state[-1]}")
+        return lines
+
+
+METRICS = []
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+SIZE_BUCKETS = (100, 1000, 5000, 10000, 25000, 50000, 100000, 250000, 500000, 1000000)
+
+REQUEST_DURATION = Histogram('radio_request_duration_seconds', 'Время обработки HTTP-запроса', LATENCY_BUCKETS, ('endpoint', 'status'))
+STAGE_DURATION = Histogram('radio_stage_duration_seconds', 'Время отдельных этапов обработки', LATENCY_BUCKETS, ('stage',))
+LLM_PROMPT_CHARS = Histogram('radio_llm_prompt_chars', 'Длина промпта, символов', SIZE_BUCKETS, ('stage',))
+LLM_RESPONSE_CHARS = Histogram('radio_llm_response_chars', 'Длина ответа Gemini, символов', SIZE_BUCKETS, ('stage',))
+LLM_TOKENS = Counter('radio_llm_tokens_total', 'Токены Gemini по данным usage_metadata', ('stage', 'kind'))
+UPSTREAM_ERRORS = Counter('radio_upstream_errors_total', 'Ошибки и таймауты вызовов Google Sheets и Gemini', ('upstream', 'stage', 'kind'))
+FALLBACKS = Counter('radio_fallbacks_total', 'Переходы на запасной вариант без AI', ('stage', 'reason'))
+STAGE1_ROUTES = Counter('radio_stage1_routes_total', 'Как выбран плейлист на этапе 1', ('path',))
+BLOCKS_SERVED = Counter('radio_blocks_served_total', 'Откуда взят отданный музыкальный блок', ('source',))
+STREAM_LISTENERS = Counter('radio_stream_listeners_total', 'Подключения к общему радиопотоку', ('sheet',))
+
+
+class timed:
+    """Контекстный менеджер: записывает длительность блока в radio_stage_duration_seconds."""
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        STAGE_DURATION.observe(time.perf_counter() - self.started, stage=self.stage)
+        return False
+
+
+def record_llm_usage(stage, prompt_chars, response_chars, usage=None):
+    LLM_PROMPT_CHARS.observe(prompt_chars, stage=stage)
+    LLM_RESPONSE_CHARS.observe(response_chars, stage=stage)
+    if usage is not None:
+        for kind, attribute in (('prompt', 'prompt_token_count'), ('response', 'candidates_token_count'),
+                                ('thoughts', 'thoughts_token_count')):
+            value = getattr(usage, attribute, None)
+            if value:
+                LLM_TOKENS.inc(value, stage=stage, kind=kind)
+
+def render_metrics():
+    """Все метрики процесса в текстовом формате Prometheus, плюс текущие значения кэшей и нагрузки."""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    cache_stats = RESPONSE_CACHE.stats()
+    counters = [
+        ('radio_response_cache_hits_total', 'Попадания в кэш ответов AI', cache_stats['hits']),
+        ('radio_response_cache_misses_total', 'Промахи кэша ответов AI', cache_stats['misses']),
+    ]
+    for name, documentation, value in counters:
+        lines.extend([f"# HELP {name} {documentation}", f"# TYPE {name} counter", f"{name} {value}"])
+    gauges = [
+        ('radio_response_cache_hit_ratio', 'Доля попаданий в кэш ответов AI', cache_stats['hitRatio']),
+        ('radio_response_cache_bytes', 'Оценка памяти кэша ответов AI', cache_stats['bytes']),
+        ('radio_prompt_fragments', 'Закэшированных фрагментов промптов', len(PROMPT_FRAGMENTS)),
+        ('radio_block_pool_blocks', 'Готовых блоков в пуле', sum(BLOCK_POOL.stats().values())),
+        ('radio_llm_in_flight', 'Вызовов Gemini в процессе', _llm_in_flight),
+        ('radio_library_age_seconds', 'Возраст снимка библиотеки', round(LIBRARY_SNAPSHOT.age(), 3) if LIBRARY_SNAPSHOT else -1),
+    ]
+    for name, documentation, value in gauges:
+        lines.extend([f"# HELP {name} {documentation}", f"# TYPE {name} gauge", f"{name} {value}"])
+    return "\n".join(lines) + "\n"
+
+
+# --- Вспомогательные функции ---
 def format_tracks_for_ai(tracks, lang_code='ru'):
     """Форматирует список треков в одну строку для промпта, используя языковые поля."""
-    library_text = ""
+    return "".join(format_track_lines_for_ai(tracks, lang_code))
+
+def format_track_lines_for_ai(tracks, lang_code='ru'):
+    """То же, что format_tracks_for_ai, но по строке на трек — чтобы собирать промпт из части треков."""
+    library_lines = []
     # Определяем ключи для языковых столбцов
     desc_key_lang = f'description_{lang_code}'
     tags_key_lang = f'tags_{lang_code}'
@@ -195,8 +391,42 @@ def format_tracks_for_ai(tracks, lang_code='ru'):
         track_info_parts.append(f"Description: {description.strip()}")
         track_info_parts.append(f"Tags: {tags.strip()}")
 
-        library_text += ", ".join(track_info_parts) + "\n"
-    return library_text
+        library_lines.append(", ".join(track_info_parts) + "\n")
+    return library_lines
+
+def format_playlists_for_ai(playlist_metadata, lang_code='ru'):
+    """Форматирует метаданные плейлистов (описания и теги) для промпта первого этапа."""
+    playlist_info_for_prompt = []
+    for sheet_name, meta in playlist_metadata.items():
+        if meta:
+            # Формируем ключи для текущего языка
+            desc_key = f'Description{lang_code.upper()}' # DescriptionRU, DescriptionEN, etc.
+            tags_key = f'Tags{lang_code.upper()}'
+
+            # Фоллбэки: сначала пробуем язык запроса, потом EN, потом RU, потом первый попавшийся
+            description = (meta.get(desc_key) or
+                           meta.get('DescriptionEN') or
+                           meta.get('DescriptionRU') or
+                           meta.get('DescriptionUK') or
+                           "Описание отсутствует")
+            tags = (meta.get(tags_key) or
+                    meta.get('TagsEN') or
+                    meta.get('TagsRU') or
+                    meta.get('TagsUK') or
+                    "Теги отсутствуют")
+            playlist_info_for_prompt.append(f"- Название плейлиста: '{sheet_name}', Описание: {description}, Теги: {tags}")
+    return "\n".join(playlist_info_for_prompt)
+
+def audio_url(music_url):
+    """Для mp3 из static/music — относительный адрес /audio/<файл> (Range, ETag и долгий кэш),
+    внешние ссылки возвращаются без изменений."""
+    url = str(music_url or '').strip()
+    parsed = urllib.parse.urlparse(url)
+    file_name = os.path.basename(parsed.path)
+    is_local = not parsed.netloc or '/static/music/' in parsed.path
+    if url and is_local and file_name in BUNDLED_MUSIC_FILES:
+        return f"/audio/{urllib.parse.quote(file_name)}"
+    return music_url
 
 def get_track_details_for_playlist(track_data, lang_code='ru'):
     """Возвращает словарь с деталями трека для конечного JSON ответа, используя языковые поля."""
@@ -211,7 +441,7 @@ def get_track_details_for_playlist(track_data, lang_code='ru'):
     return {
         "title": track_data.get('title'),
         "artist": track_data.get('artist'),
-        "musicUrl": track_data.get('music_url'),
+        "musicUrl": audio_url(track_data.get('music_url')),
         "mood": track_data.get('mood'),
         "description": description.strip() # Отдаем описание на нужном языке (с фоллбэком)
         # Теги можно не отдавать клиенту, если они не нужны для отображения,
@@ -219,98 +449,532 @@ def get_track_details_for_playlist(track_data, lang_code='ru'):
     }
 
 
-# --- API ЭНДПОИНТЫ ---
+# --- Локальный выбор плейлиста (BM25) ---
+def tokenize_for_search(text):
+    """Разбивает текст на слова в нижнем регистре и грубо обрезает окончания,
+    чтобы 'джаз'/'джаза' и 'спокойный'/'спокойное' совпадали без морфологического словаря."""
+    tokens = []
+    for word in re.findall(r"\w+", str(text).lower()):
+        if len(word) < 2 or word.isdigit():
+            continue
+        tokens.append(word[:SEARCH_STEM_LENGTH])
+    return tokens
 
-@app.route('/')
-def index():
-    return "Flask-сервер для AI Радио работает! Метаданные плейлистов загружены: " + ("Да" if PLAYLIST_METADATA else "Нет")
 
-@app.route('/get-full-playlist', methods=['GET'])
-def get_full_playlist_route():
-    print("Запрос на /get-full-playlist получен.")
-    if not sh:
-        return jsonify({"error": "Сервис Google Sheets не инициализирован."}), 500
+class BM25Index:
+    """Небольшой BM25-индекс над списком документов (каждый документ — список токенов)."""
 
-    lang_code = request.args.get('language', 'ru').lower() # Получаем язык из query params
+    def __init__(self, documents, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.doc_count = len(documents)
+        self.doc_lengths = [len(doc) for doc in documents]
+        self.avg_length = (sum(self.doc_lengths) / self.doc_count) if self.doc_count else 0.0
+        self.postings = {} # {токен: [(номер документа, частота)]}
+        for doc_id, doc in enumerate(documents):
+            frequencies = {}
+            for token in doc:
+                frequencies[token] = frequencies.get(token, 0) + 1
+            for token, freq in frequencies.items():
+                self.postings.setdefault(token, []).append((doc_id, freq))
+        self.idf = {
+            token: math.log(1 + (self.doc_count - len(posting) + 0.5) / (len(posting) + 0.5))
+            for token, posting in self.postings.items()
+        }
 
-    try:
-        # Попробуем взять первый лист, который есть в метаданных, как основной
-        # Или просто первый лист, если метаданные пусты
-        target_sheet_title = None
-        if PLAYLIST_METADATA:
-            target_sheet_title = next(iter(PLAYLIST_METADATA.keys()), None)
-
-        if target_sheet_title:
-            worksheet = sh.worksheet(target_sheet_title)
-            print(f"Загрузка треков для /get-full-playlist с листа (из метаданных): {worksheet.title}")
-        else:
-            # Фоллбек: просто первый лист, исключая мета-лист
-            all_sheets = sh.worksheets()
-            app_sheets = [s for s in all_sheets if s.title != PLAYLIST_METADATA_SHEET_NAME]
-            if not app_sheets:
-                 return jsonify({"error": "В таблице нет листов с треками (кроме, возможно, мета-листа)."}), 500
-            worksheet = app_sheets[0]
-            print(f"Загрузка треков для /get-full-playlist с первого доступного листа: {worksheet.title}")
-
-        all_tracks_raw = get_all_tracks_from_sheet(worksheet)
-    except Exception as e:
-        print(f"Ошибка при получении первого листа или треков: {e}")
-        return jsonify({"error": "Не удалось загрузить музыкальную библиотеку."}), 500
+    def scores(self, query_tokens):
+        """Возвращает {номер документа: score} только для документов, где есть хотя бы одно слово запроса."""
+        result = {}
+        for token in set(query_tokens):
+            posting = self.postings.get(token)
+            if not posting:
+                continue
+            idf = self.idf[token]
+            for doc_id, freq in posting:
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_id] / (self.avg_length or 1))
+                result[doc_id] = result.get(doc_id, 0.0) + idf * freq * (self.k1 + 1) / (freq + norm)
+        return result
 
-    if not all_tracks_raw:
-        return jsonify({"error": "Библиотека музыки пуста или не удалось загрузить треки"}), 404
 
-    playlist = [get_track_details_for_playlist(track, lang_code) for track in all_tracks_raw]
-    return jsonify({"playlist": playlist})
+class PlaylistRouter:
+    """Выбирает плейлист по тегам и описаниям из мета-листа на всех языках без обращения к LLM."""
 
+    TEXT_FIELDS = ('DescriptionRU', 'DescriptionEN', 'DescriptionUK', 'TagsRU', 'TagsEN', 'TagsUK')
+    TAG_FIELDS = ('TagsRU', 'TagsEN', 'TagsUK')
 
-@app.route('/get-radio-play', methods=['POST'])
-def get_radio_play():
-    if not client or not sh:  # <-- ИСПРАВЛЕНО: было model
-        return jsonify({"error": "Сервер не настроен должным образом (проблема с Google Sheets или Gemini API)."}), 500
-    if not PLAYLIST_METADATA:
-        return jsonify({"error": f"Метаданные плейлистов не загружены. Проверьте лист '{PLAYLIST_METADATA_SHEET_NAME}'."}), 500
+    def __init__(self, playlist_metadata):
+        self.sheet_names = list(playlist_metadata.keys())
+        documents = []
+        for sheet_name in self.sheet_names:
+            meta = playlist_metadata[sheet_name] or {}
+            tokens = tokenize_for_search(sheet_name)
+            for field in self.TEXT_FIELDS:
+                tokens.extend(tokenize_for_search(meta.get(field, '')))
+            for field in self.TAG_FIELDS:
+                # Теги точнее описаний, поэтому учитываем их дважды
+                tokens.extend(tokenize_for_search(meta.get(field, '')))
+            documents.append(tokens)
+        self.index = BM25Index(documents)
+        self.document_tokens = [set(tokens) for tokens in documents]
+
+    def route(self, user_request):
+        """Возвращает (название листа или None, уверенность 0..1).
+        Уверенность — доля слов запроса, найденных в лучшем плейлисте, умноженная на его относительный
+        отрыв от второго: одно совпавшее слово из длинного запроса не даёт уверенного выбора."""
+        query_tokens = set(tokenize_for_search(user_request))
+        scores = self.index.scores(query_tokens)
+        if not scores:
+            return None, 0.0
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        best_doc, best_score = ranked[0]
+        second_score = ranked[1][1] if len(ranked) > 1 else 0.0
+        margin = (best_score - second_score) / best_score if best_score > 0 else 0.0
+        coverage = len(query_tokens & self.document_tokens[best_doc]) / len(query_tokens)
+        return self.sheet_names[best_doc], round(margin * coverage, 3)
+
+
+# --- Кэш фрагментов промптов ---
+class PromptFragmentCache:
+    """LRU-кэш готовых фрагментов промптов (список плейлистов, описание библиотеки).
+    Ключи включают версию библиотеки, а при смене снимка кэш очищается целиком."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_build(self, key, builder):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        # Строим вне блокировки: повторная сборка при гонке безвредна, а другие запросы не ждут
+        value = builder()
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+PROMPT_FRAGMENTS = PromptFragmentCache(PROMPT_CACHE_MAX_ENTRIES)
+
+# --- Кэш ответов AI ---
+class ResponseCache:
+    """LRU-кэш решений AI (выбор листа на этапе 1, набор треков и подводка на этапе 2) с TTL
+    и ограничением по памяти. Размер записи оценивается по длине её JSON-представления."""
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict() # {ключ: (истекает в, размер, значение)}
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[2]
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.total_bytes -= size
+
+    def _store(self, key, value, size=None):
+        if size is None:
+            size = len(json.dumps(value, ensure_ascii=False, default=str))
+        size += 64
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.time() + self.ttl, size, value)
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))
+
+    def get(self, key):
+        with self._lock:
+            value = self._lookup(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def put(self, key, value, size=None):
+        """size — размер значения в байтах, если его нельзя оценить по JSON (например, для bytes)."""
+        with self._lock:
+            self._store(key, value, size)
+
+    def choose_variant(self, key, wanted_variants=1):
+        """Случайный из закэшированных вариантов. Пока вариантов меньше wanted_variants, считается промахом,
+        чтобы накопить несколько разных блоков и слушатели не получали один и тот же набор."""
+        with self._lock:
+            variants = self._lookup(key)
+            if not variants or len(variants) < wanted_variants:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return random.choice(variants)
+
+    def add_variant(self, key, variant, max_variants=1):
+        with self._lock:
+            variants = list(self._lookup(key) or [])
+            variants.append(variant)
+            self._store(key, variants[-max_variants:])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
 
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRatio": round(self.hits / lookups, 3) if lookups else 0.0
+            }
+
+
+RESPONSE_CACHE = ResponseCache(RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL)
+ENCODED_BODIES = ResponseCache(ENCODED_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL) # Готовые тела /get-full-playlist: (кодировка, bytes)
+
+# --- Объединение одинаковых запросов (single-flight) ---
+class _FlightCall:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Объединяет одновременные вызовы с одинаковым ключом: функцию выполняет первый (ведущий) вызов,
+    остальные ждут и получают тот же результат или то же исключение."""
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def in_flight(self, key):
+        with self._lock:
+            return key in self._calls
+
+    def join(self, key):
+        """Низкоуровневый вариант do() для ведущих, которые не укладываются в одну функцию (например, потоковых).
+        Возвращает (вызов, ведущий ли): ведущий обязан завершить вызов через finish(), остальные — ждать через wait()."""
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = _FlightCall()
+                self._calls[key] = call
+        return call, is_leader
+
+    def finish(self, key, call, result=None, error=None):
+        call.result = result
+        call.error = error
+        with self._lock:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+        call.event.set()
+
+    def wait(self, call, timeout=None):
+        if not call.event.wait(timeout):
+            raise UpstreamTimeout(f"не дождались общего вызова '{self.name}' за {timeout} c")
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def do(self, key, fn, timeout=None):
+        call, is_leader = self.join(key)
+        if not is_leader:
+            return self.wait(call, timeout)
+        try:
+            result = fn()
+        except BaseException as e:
+            self.finish(key, call, error=e)
+            raise
+        self.finish(key, call, result=result)
+        return result
+
+
+def normalize_request(text):
+    """Нормализованный текст пожелания для ключей кэшей: нижний регистр, без пунктуации и лишних пробелов."""
+    return " ".join(re.findall(r"\w+", str(text).lower()))
+
+def personalize_speech(speech_text, user_name, user_request=None):
+    """Подставляет имя слушателя (и, для блоков из пула, его пожелание) вместо заглушек общей подводки."""
+    speech_text = speech_text.replace(LISTENER_NAME_PLACEHOLDER, str(user_name))
+    if user_request is not None:
+        speech_text = speech_text.replace(REQUEST_PLACEHOLDER, str(user_request))
+    return speech_text
+
+
+def split_placeholder_tail(text):
+    """Делит подводку из потока на часть, готовую к personalize_speech, и хвост, который может оказаться
+    началом заглушки имени, разрезанной между кусками ответа. Возвращает (готовая часть, хвост)."""
+    for size in range(min(len(text), len(LISTENER_NAME_PLACEHOLDER) - 1), 0, -1):
+        if LISTENER_NAME_PLACEHOLDER.startswith(text[-size:]):
+            return text[:-size], text[-size:]
+    return text, ""
+
+
+LIBRARY_FLIGHTS = SingleFlight('sheets')
+AI_FLIGHTS = SingleFlight('gemini')
+
+# --- Кэш музыкальной библиотеки ---
+class TrackStore:
+    """Треки одного листа с индексом по ID и заранее собранными ответами для каждого языка."""
+
+    SEARCH_FIELDS = ('title', 'artist', 'genre', 'mood', 'tags_ru', 'tags_en', 'tags_uk', 'tags')
+
+    def __init__(self, sheet_name, tracks, languages):
+        self.sheet_name = sheet_name
+        self.tracks = tracks
+        self.index_by_id = {}
+        for position, track in enumerate(tracks):
+            # При дублях ID побеждает первый трек, как и раньше при линейном поиске
+            self.index_by_id.setdefault(str(track.get('id')).strip(), position)
+        self.details_by_lang = {
+            lang_code: [get_track_details_for_playlist(track, lang_code) for track in tracks]
+            for lang_code in languages
+        }
+        self.search_index = BM25Index([
+            tokenize_for_search(" ".join(str(track.get(field) or '') for field in self.SEARCH_FIELDS))
+            for track in tracks
+        ])
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def find_index(self, track_id):
+        return self.index_by_id.get(str(track_id).strip())
+
+    def select_candidates(self, user_request, limit):
+        """Отбирает до limit треков-кандидатов для второго этапа.
+        Большая часть — самые релевантные запросу (не больше STAGE2_MAX_PER_ARTIST на исполнителя),
+        остаток — случайные треки, чтобы подборка не сводилась к одному жанру.
+        Возвращает номера треков в порядке убывания релевантности."""
+        if len(self.tracks) <= limit:
+            return list(range(len(self.tracks)))
+
+        scores = self.search_index.scores(tokenize_for_search(user_request))
+        ranked = sorted(scores, key=scores.get, reverse=True)
+        relevant_limit = max(1, int(limit * (1 - STAGE2_EXPLORATION_SHARE)))
+
+        selected = []
+        chosen = set()
+        per_artist = {}
+        for position in ranked:
+            if len(selected) >= relevant_limit:
+                break
+            artist = str(self.tracks[position].get('artist') or '').strip().lower()
+            if per_artist.get(artist, 0) >= STAGE2_MAX_PER_ARTIST:
+                continue
+            per_artist[artist] = per_artist.get(artist, 0) + 1
+            selected.append(position)
+            chosen.add(position)
+
+        # Добираем случайными треками, по возможности от ещё не представленных исполнителей
+        remaining = [position for position in range(len(self.tracks)) if position not in chosen]
+        random.shuffle(remaining)
+        remaining.sort(key=lambda position: per_artist.get(str(self.tracks[position].get('artist') or '').strip().lower(), 0))
+        selected.extend(remaining[:limit - len(selected)])
+        return selected
+
+    def details(self, lang_code):
+        """Готовый список деталей треков для языка; для неизвестных языков считается на лету без кэширования."""
+        prepared = self.details_by_lang.get(lang_code)
+        if prepared is None:
+            prepared = [get_track_details_for_playlist(track, lang_code) for track in self.tracks]
+        return prepared
+
+
+class LibrarySnapshot:
+    """Снимок библиотеки: метаданные плейлистов и треки всех листов (данные после загрузки не меняются)."""
+
+    def __init__(self, metadata, sheets):
+        self.metadata = metadata # {SheetName: запись из мета-листа}
+        self.sheets = sheets # {название листа: список записей}
+        self.loaded_at = time.time()
+        # Версия зависит только от содержимого, поэтому неизменившаяся таблица сохраняет версию
+        payload = json.dumps([metadata, sheets], ensure_ascii=False, sort_keys=True, default=str)
+        self.version = hashlib.sha1(payload.encode('utf-8')).hexdigest()[:12]
+        self.stores = {} # {название листа: TrackStore}, заполняется в build_indexes()
+        self.router = None # PlaylistRouter по метаданным, заполняется в build_indexes()
+
+    def build_indexes(self):
+        for sheet_name, tracks in self.sheets.items():
+            self.stores[sheet_name] = TrackStore(sheet_name, tracks, PROMPT_TEMPLATES.keys())
+        self.router = PlaylistRouter(self.metadata)
+
+    def age(self):
+        return time.time() - self.loaded_at
+
+    def default_sheet_name(self):
+        """Основной лист: первый из метаданных, иначе первый лист с треками."""
+        for sheet_name in self.metadata:
+            if sheet_name in self.sheets:
+                return sheet_name
+        return next(iter(self.sheets), None)
+
+
+_library_refresher_started = False
+_last_refresh_attempt = 0.0
+
+def load_library_snapshot(spreadsheet_obj):
+    """Читает мета-лист и все листы с треками из Google Sheets и возвращает новый LibrarySnapshot."""
+    metadata = {}
     try:
-        data = request.get_json(force=True)
-        user_request = data.get('request', 'удиви меня')
-        user_name = data.get('userName', 'слушатель')
-        lang_code = data.get('language', 'ru').lower()
-        if lang_code not in PROMPT_TEMPLATES:
-            print(f"Предупреждение: Неподдерживаемый код языка '{lang_code}'. Используется 'ru'.")
-            lang_code = 'ru'
+        metadata_sheet = spreadsheet_obj.worksheet(PLAYLIST_METADATA_SHEET_NAME)
+        for record in metadata_sheet.get_all_records():
+            # Проверяем, что есть SheetName, чтобы избежать пустых строк
+            if record.get('SheetName'):
+                metadata[record['SheetName']] = record
+        if not metadata:
+            print(f"Предупреждение: Метаданные плейлистов из листа '{PLAYLIST_METADATA_SHEET_NAME}' не загружены или лист пуст.")
+    except gspread.exceptions.WorksheetNotFound:
+        print(f"КРИТИЧЕСКАЯ ОШИБКА: Мета-лист '{PLAYLIST_METADATA_SHEET_NAME}' не найден в таблице.")
+
+    sheets = {}
+    for worksheet in spreadsheet_obj.worksheets():
+        if worksheet.title == PLAYLIST_METADATA_SHEET_NAME:
+            continue
+        sheets[worksheet.title] = worksheet.get_all_records()
+    return LibrarySnapshot(metadata, sheets)
+
+def set_library_snapshot(snapshot):
+    """Атомарно подменяет текущий снимок библиотеки."""
+    global LIBRARY_SNAPSHOT, PLAYLIST_METADATA
+    if not snapshot.stores:
+        snapshot.build_indexes()
+    LIBRARY_SNAPSHOT = snapshot
+    PLAYLIST_METADATA = snapshot.metadata
+    PROMPT_FRAGMENTS.clear() # Фрагменты старой версии больше не понадобятся
+    RESPONSE_CACHE.clear() # Решения AI ссылаются на треки старой версии
+    ENCODED_BODIES.clear()
+    BLOCK_POOL.clear()
+
+def _reload_library():
+    if sh is None and connect_to_sheets() is None:
+        raise RuntimeError("нет подключения к Google Sheets")
+    started = time.time()
+    try:
+        with timed('sheets_fetch'):
+            snapshot = load_library_snapshot(sh)
+    except Exception:
+        UPSTREAM_ERRORS.inc(upstream='sheets', stage='sheets_fetch', kind='error')
+        raise
+    if LIBRARY_SNAPSHOT is not None and snapshot.version == LIBRARY_SNAPSHOT.version:
+        # Данные не изменились — оставляем старый снимок вместе с индексами, только отмечаем свежесть
+        LIBRARY_SNAPSHOT.loaded_at = snapshot.loaded_at
+    else:
+        with timed('library_index'):
+            set_library_snapshot(snapshot)
+        print(f"Библиотека загружена: версия {snapshot.version}, плейлистов с метаданными: {len(snapshot.metadata)}, "
+              f"листов: {len(snapshot.sheets)}, треков: {sum(len(t) for t in snapshot.sheets.values())} "
+              f"({time.time() - started:.2f} c).")
+        save_library_snapshot_to_disk(snapshot)
+    return LIBRARY_SNAPSHOT
+
+def refresh_library(blocking=True):
+    """Перечитывает библиотеку из Google Sheets. При ошибке остаётся прежний (устаревший) снимок.
+    Одновременные обновления (фоновое, ручное) объединяются в одну загрузку.
+    Возвращает актуальный снимок или None, если обновление уже идёт и blocking=False."""
+    global _last_refresh_attempt
+    if not blocking and LIBRARY_FLIGHTS.in_flight('library'):
+        return None
+    _last_refresh_attempt = time.time()
+    try:
+        return LIBRARY_FLIGHTS.do('library', _reload_library)
     except Exception as e:
-        print(f"Ошибка получения JSON из запроса: {e}")
-        return jsonify({"error": "Неверный формат запроса. Ожидается JSON."}), 400
+        print(f"Ошибка при обновлении библиотеки из Google Sheets: {e}. Продолжаю работать со старым снимком.")
+        return LIBRARY_SNAPSHOT
 
-    # --- ЭТАП 1: AI ВЫБИРАЕТ ЛИСТ НА ОСНОВЕ МЕТАДАННЫХ ---
-    playlist_info_for_prompt = []
-    available_playlist_names = list(PLAYLIST_METADATA.keys()) # Плейлисты, для которых есть метаданные
+def _library_refresher_loop():
+    while True:
+        time.sleep(LIBRARY_REFRESH_INTERVAL)
+        refresh_library()
 
-    if not available_playlist_names:
-         return jsonify({"error": f"В таблице Google Sheets нет плейлистов с метаданными в '{PLAYLIST_METADATA_SHEET_NAME}'."}), 500
+def start_library_refresher():
+    """Запускает фоновый поток периодического обновления библиотеки (один раз на процесс)."""
+    global _library_refresher_started
+    if _library_refresher_started or LIBRARY_REFRESH_INTERVAL <= 0:
+        return
+    _library_refresher_started = True
+    threading.Thread(target=_library_refresher_loop, name="library-refresher", daemon=True).start()
 
-    for sheet_name in available_playlist_names:
-        meta = PLAYLIST_METADATA.get(sheet_name)
-        if meta:
-            # Формируем ключи для текущего языка
-            desc_key = f'Description{lang_code.upper()}' # DescriptionRU, DescriptionEN, etc.
-            tags_key = f'Tags{lang_code.upper()}'
+def get_library_snapshot():
+    """Возвращает текущий снимок без ожидания сети (stale-while-revalidate):
+    если снимок устарел, обновление запускается в фоне, а запрос обслуживается старыми данными."""
+    snapshot = LIBRARY_SNAPSHOT
+    if snapshot is not None and LIBRARY_REFRESH_INTERVAL > 0 and snapshot.age() > LIBRARY_REFRESH_INTERVAL * 2 \
+            and time.time() - _last_refresh_attempt > min(60, LIBRARY_REFRESH_INTERVAL) \
+            and not LIBRARY_FLIGHTS.in_flight('library'):
+        # Фоновый поток почему-то отстал — обновляем вне очереди, не блокируя запрос
+        threading.Thread(target=refresh_library, kwargs={'blocking': False}, daemon=True).start()
+    return snapshot
 
-            # Фоллбэки: сначала пробуем язык запроса, потом EN, потом RU, потом первый попавшийся
-            description = (meta.get(desc_key) or
-                           meta.get('DescriptionEN') or
-                           meta.get('DescriptionRU') or
-                           meta.get('DescriptionUK') or
-                           "Описание отсутствует")
-            tags = (meta.get(tags_key) or
-                    meta.get('TagsEN') or
-                    meta.get('TagsRU') or
-                    meta.get('TagsUK') or
-                    "Теги отсутствуют")
-            playlist_info_for_prompt.append(f"- Название плейлиста: '{sheet_name}', Описание: {description}, Теги: {tags}")
 
-    worksheet_details_joined = "\n".join(playlist_info_for_prompt)
+def build_library_description(snapshot, track_store, user_request, lang_code):
+    """Описание библиотеки для промпта этапа 2. Небольшие листы отдаются целиком (строка кэшируется),
+    из больших берутся только кандидаты, отобранные локальным поиском по запросу."""
+    if len(track_store) <= STAGE2_MAX_CANDIDATES:
+        return PROMPT_FRAGMENTS.get_or_build(
+            ('stage2', snapshot.version, track_store.sheet_name, lang_code),
+            lambda: format_tracks_for_ai(track_store.tracks, lang_code)
+        )
+    track_lines = PROMPT_FRAGMENTS.get_or_build(
+        ('stage2_lines', snapshot.version, track_store.sheet_name, lang_code),
+        lambda: format_track_lines_for_ai(track_store.tracks, lang_code)
+    )
+    candidates = track_store.select_candidates(user_request, STAGE2_MAX_CANDIDATES)
+    logger.debug("Для этапа 2 отобрано %d из %d треков плейлиста '%s'.", len(candidates), len(track_store), track_store.sheet_name)
+    return "".join(track_lines[position] for position in candidates)
+
+
+def select_playlist(snapshot, user_request, lang_code):
+    with timed('stage1'):
+        selected_sheet_name, routing = _select_playlist(snapshot, user_request, lang_code)
+    STAGE1_ROUTES.inc(path=routing['path'])
+    return selected_sheet_name, routing
+
+def _select_playlist(snapshot, user_request, lang_code):
+    """Этап 1: выбирает лист по метаданным. Сначала пробует локальный BM25-роутер,
+    затем кэш прошлых решений, к Gemini обращается только при низкой уверенности и промахе кэша.
+    Возвращает (название листа, {"path": local / cache / llm / fallback, "confidence"})."""
+    available_playlist_names = list(snapshot.metadata.keys())
+
+    local_choice, confidence = snapshot.router.route(user_request) if snapshot.router else (None, 0.0)
+    if local_choice and confidence >= ROUTER_CONFIDENCE_THRESHOLD:
+        logger.debug("Локальный роутер выбрал плейлист: '%s' (уверенность %s, язык: %s)", local_choice, confidence, lang_code)
+        return local_choice, {"path": "local", "confidence": confidence}
+
+    worksheet_details_joined = PROMPT_FRAGMENTS.get_or_build(
+        ('stage1', snapshot.version, lang_code),
+        lambda: format_playlists_for_ai(snapshot.metadata, lang_code)
+    )
 
     prompt_stage1_template = PROMPT_TEMPLATES[lang_code]['stage1'] # Используем обновленный stage1
     prompt_stage1 = prompt_stage1_template.format(
@@ -318,34 +982,963 @@ def get_radio_play():
         worksheet_details_joined=worksheet_details_joined
     )
 
+    stage1_cache_key = ('stage1', snapshot.version, lang_code, normalize_request(user_request))
+    cached_sheet_name = RESPONSE_CACHE.get(stage1_cache_key)
+    if cached_sheet_name in available_playlist_names:
+        logger.debug("Плейлист из кэша: '%s' (язык: %s)", cached_sheet_name, lang_code)
+        return cached_sheet_name, {"path": "cache", "confidence": confidence}
+
     selected_sheet_name = ""
     try:
-        print(f"\n--- Промпт для Этапа 1 (язык: {lang_code}) ---\n{prompt_stage1}\n----------------------------")
-        response_stage1 = client.models.generate_content(model="gemini-2.5-flash", contents=prompt_stage1)  # <-- ИСПРАВЛЕНО
-        selected_sheet_name = response_stage1.text.strip()  # <-- ИСПРАВЛЕНО: было raw_text = ..., selected_sheet_name не присваивался
+        log_prompt(f"Промпт для Этапа 1 (язык: {lang_code})", prompt_stage1)
+        # Одинаковые одновременные запросы ждут один общий вызов Gemini
+        response_text = AI_FLIGHTS.do(
+            stage1_cache_key,
+            lambda: generate_with_deadline(prompt_stage1, STAGE1_TIMEOUT, 'stage1').text or "",
+            timeout=STAGE1_TIMEOUT
+        )
+        selected_sheet_name = response_text.strip()
         # Иногда AI может добавить кавычки, убираем их
         selected_sheet_name = selected_sheet_name.strip("'\"")
-        print(f"AI выбрал плейлист: '{selected_sheet_name}' (Запрос на языке: {lang_code})")
+        logger.debug("AI выбрал плейлист: '%s' (Запрос на языке: %s)", selected_sheet_name, lang_code)
 
         if selected_sheet_name not in available_playlist_names:
-            print(f"Предупреждение: AI вернул имя листа ('{selected_sheet_name}'), которого нет в метаданных. Выбираю случайный из доступных.")
-            selected_sheet_name = random.choice(available_playlist_names)
+            logger.warning("AI вернул имя листа ('%s'), которого нет в метаданных. Выбираю случайный из доступных.", selected_sheet_name)
+            FALLBACKS.inc(stage='stage1', reason='unknown_sheet')
+            selected_sheet_name = local_choice or random.choice(available_playlist_names)
+            return selected_sheet_name, {"path": "fallback", "confidence": confidence}
     except Exception as e:
-        print(f"Ошибка на 1-м этапе вызова AI: {e}. Выбираю случайный плейлист из метаданных.")
-        selected_sheet_name = random.choice(available_playlist_names)
+        logger.warning("Ошибка на 1-м этапе вызова AI: %s. Выбираю случайный плейлист из метаданных.", e)
+        FALLBACKS.inc(stage='stage1', reason='timeout' if isinstance(e, UpstreamTimeout) else 'error')
+        selected_sheet_name = local_choice or random.choice(available_playlist_names)
+        return selected_sheet_name, {"path": "fallback", "confidence": confidence}
+    RESPONSE_CACHE.put(stage1_cache_key, selected_sheet_name)
+    return selected_sheet_name, {"path": "llm", "confidence": confidence}
 
-    # --- ЭТАП 2: AI ВЫБИРАЕТ ТРЕКИ ИЗ ЛИСТА ---
+
+# --- Локальный снимок библиотеки на диске ---
+def save_library_snapshot_to_disk(snapshot, path=None):
+    """Сохраняет снимок в SQLite-файл (по строке JSON на лист). Пишет во временный файл и атомарно
+    подменяет старый, чтобы параллельный старт другого воркера никогда не прочитал половину файла."""
+    path = path or LIBRARY_SNAPSHOT_PATH
+    if not path:
+        return
+    temp_path = f"{path}.{os.getpid()}.tmp"
     try:
-        selected_worksheet = sh.worksheet(selected_sheet_name)
-        all_tracks_from_selected_sheet = get_all_tracks_from_sheet(selected_worksheet)
-        if not all_tracks_from_selected_sheet:
-            return jsonify({"error": f"Плейлист '{selected_sheet_name}' пуст или не удалось загрузить треки."}), 500
-    except gspread.exceptions.WorksheetNotFound:
-         return jsonify({"error": f"Плейлист с названием '{selected_sheet_name}' не найден в таблице."}), 404
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        connection = sqlite3.connect(temp_path)
+        try:
+            connection.execute("CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT)")
+            connection.execute("CREATE TABLE sheets (position INTEGER PRIMARY KEY, name TEXT, is_metadata INTEGER, records TEXT)")
+            connection.executemany("INSERT INTO info VALUES (?, ?)", [
+                ('version', snapshot.version),
+                ('loaded_at', repr(snapshot.loaded_at)),
+            ])
+            rows = [(0, PLAYLIST_METADATA_SHEET_NAME, 1, json.dumps(list(snapshot.metadata.values()), ensure_ascii=False, default=str))]
+            for position, (sheet_name, records) in enumerate(snapshot.sheets.items(), start=1):
+                rows.append((position, sheet_name, 0, json.dumps(records, ensure_ascii=False, default=str)))
+            connection.executemany("INSERT INTO sheets VALUES (?, ?, ?, ?)", rows)
+            connection.commit()
+        finally:
+            connection.close()
+        os.replace(temp_path, path)
+    except Exception as e:
+        print(f"Не удалось сохранить локальный снимок библиотеки в '{path}': {e}")
+
+def load_library_snapshot_from_disk(path=None):
+    """Читает снимок, сохранённый save_library_snapshot_to_disk. Возвращает LibrarySnapshot или None."""
+    path = path or LIBRARY_SNAPSHOT_PATH
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            info = dict(connection.execute("SELECT key, value FROM info"))
+            rows = connection.execute("SELECT name, is_metadata, records FROM sheets ORDER BY position").fetchall()
+        finally:
+            connection.close()
     except Exception as e:
-        return jsonify({"error": f"Не удалось загрузить плейлист '{selected_sheet_name}': {e}"}), 500
+        print(f"Не удалось прочитать локальный снимок библиотеки '{path}': {e}")
+        return None
+
+    metadata = {}
+    sheets = {}
+    for name, is_metadata, records in rows:
+        if is_metadata:
+            metadata = {record['SheetName']: record for record in json.loads(records) if record.get('SheetName')}
+        else:
+            sheets[name] = json.loads(records)
+    snapshot = LibrarySnapshot(metadata, sheets)
+    # Возраст считаем от исходной загрузки из Google Sheets, чтобы старый файл быстро обновился
+    snapshot.loaded_at = float(info.get('loaded_at', 0))
+    return snapshot
+
+def start_library():
+    """Старт без ожидания сети: если есть локальный снимок, сервер сразу отвечает по нему,
+    а подключение к Google Sheets и свежая загрузка идут в фоне. Без снимка ждём первую загрузку, как раньше."""
+    local_snapshot = load_library_snapshot_from_disk()
+    if local_snapshot is not None:
+        set_library_snapshot(local_snapshot)
+        print(f"Библиотека загружена из локального снимка: версия {local_snapshot.version}, "
+              f"листов: {len(local_snapshot.sheets)}. Обновление из Google Sheets — в фоне.")
+        threading.Thread(target=refresh_library, name="library-initial-refresh", daemon=True).start()
+    else:
+        refresh_library()
+    start_library_refresher()
+
+
+# --- Вызовы Gemini с ограничением параллельности и дедлайнами ---
+class UpstreamTimeout(Exception):
+    """Вызов Gemini не уложился в дедлайн этапа или не дождался свободного слота."""
+
+
+# Этап 2 просит у Gemini JSON строго по схеме: без ```json и текста вокруг.
+# playlist идёт первым, чтобы при потоковой генерации треки приходили раньше подводки
+STAGE2_RESPONSE_CONFIG = genai_types.GenerateContentConfig(
+    response_mime_type="application/json",
+    response_schema=genai_types.Schema(
+        type=genai_types.Type.OBJECT,
+        properties={
+            "playlist": genai_types.Schema(type=genai_types.Type.ARRAY, items=genai_types.Schema(type=genai_types.Type.STRING)),
+            "speechText": genai_types.Schema(type=genai_types.Type.STRING)
+        },
+        required=["playlist", "speechText"],
+        property_ordering=["playlist", "speechText"]
+    )
+) if STAGE2_STRUCTURED_OUTPUT else None
+
+_llm_slots = threading.BoundedSemaphore(LLM_MAX_CONCURRENCY)
+_llm_executor = ThreadPoolExecutor(max_workers=LLM_MAX_CONCURRENCY, thread_name_prefix="gemini")
+_llm_in_flight = 0
+_llm_in_flight_lock = threading.Lock()
+
+def _acquire_llm_slot(timeout):
+    global _llm_in_flight
+    if not _llm_slots.acquire(timeout=timeout):
+        raise UpstreamTimeout(f"нет свободного слота для вызова Gemini за {timeout} c")
+    with _llm_in_flight_lock:
+        _llm_in_flight += 1
 
-    library_description = format_tracks_for_ai(all_tracks_from_selected_sheet, lang_code)
+def _release_llm_slot():
+    global _llm_in_flight
+    with _llm_in_flight_lock:
+        _llm_in_flight -= 1
+    _llm_slots.release()
+
+def llm_load():
+    """Доля занятых слотов Gemini (0..1) — мера нагрузки для пула готовых блоков."""
+    return _llm_in_flight / LLM_MAX_CONCURRENCY
+
+def deadline_config(config, remaining):
+    """Копия config с HTTP-таймаутом по оставшемуся времени этапа: зависший вызов освобождает слот
+    вскоре после дедлайна, а не через общий таймаут клиента."""
+    http_options = genai_types.HttpOptions(timeout=max(1000, int((remaining + 1) * 1000)))
+    if config is None:
+        return genai_types.GenerateContentConfig(http_options=http_options)
+    return config.model_copy(update={'http_options': http_options})
+
+def generate_with_deadline(prompt, timeout, stage, config=None):
+    """Вызывает Gemini, но ждёт ответа не дольше timeout секунд (включая ожидание слота).
+    Поток запроса освобождается по дедлайну, а слот остаётся занятым, пока вызов реально не завершится,
+    поэтому одновременно к Gemini уходит не больше LLM_MAX_CONCURRENCY запросов."""
+    started = time.monotonic()
+    try:
+        _acquire_llm_slot(timeout)
+    except UpstreamTimeout:
+        UPSTREAM_ERRORS.inc(upstream='gemini', stage=stage, kind='overload')
+        raise
+    try:
+        call_config = deadline_config(config, timeout - (time.monotonic() - started))
+        future = _llm_executor.submit(client.models.generate_content, model="gemini-2.5-flash", contents=prompt, config=call_config)
+    except Exception:
+        _release_llm_slot()
+        raise
+    future.add_done_callback(lambda _: _release_llm_slot())
+    try:
+        with timed(f"{stage}_llm"):
+            response = future.result(timeout=max(0.0, timeout - (time.monotonic() - started)))
+    except (FutureTimeoutError, httpx.TimeoutException):
+        UPSTREAM_ERRORS.inc(upstream='gemini', stage=stage, kind='timeout')
+        raise UpstreamTimeout(f"Gemini не ответил за {timeout} c")
+    except Exception:
+        UPSTREAM_ERRORS.inc(upstream='gemini', stage=stage, kind='error')
+        raise
+    record_llm_usage(stage, len(prompt), len(response.text or ""), getattr(response, 'usage_metadata', None))
+    return response
+
+def stream_with_deadline(prompt, timeout, stage, config=None):
+    """Потоковый вызов Gemini с теми же ограничениями: отдаёт куски ответа, пока не истёк дедлайн.
+    Между кусками (и до первого) ждёт не дольше оставшегося времени — это таймаут чтения HTTP."""
+    started = time.monotonic()
+    try:
+        _acquire_llm_slot(timeout)
+    except UpstreamTimeout:
+        UPSTREAM_ERRORS.inc(upstream='gemini', stage=stage, kind='overload')
+        raise
+    response_chars = 0
+    usage = None
+    try:
+        call_config = deadline_config(config, timeout - (time.monotonic() - started))
+        for chunk in client.models.generate_content_stream(model="gemini-2.5-flash", contents=prompt, config=call_config):
+            response_chars += len(chunk.text or "")
+            usage = getattr(chunk, 'usage_metadata', None) or usage
+            yield chunk
+            if time.monotonic() - started > timeout:
+                UPSTREAM_ERRORS.inc(upstream='gemini', stage=stage, kind='timeout')
+                raise UpstreamTimeout(f"Gemini не закончил ответ за {timeout} c")
+    except UpstreamTimeout:
+        raise
+    except httpx.TimeoutException:
+        UPSTREAM_ERRORS.inc(upstream='gemini', stage=stage, kind='timeout')
+        raise UpstreamTimeout(f"Gemini не прислал ответ за {timeout} c")
+    except Exception:
+        UPSTREAM_ERRORS.inc(upstream='gemini', stage=stage, kind='error')
+        raise
+    finally:
+        _release_llm_slot()
+        STAGE_DURATION.observe(time.monotonic() - started, stage=f"{stage}_llm")
+    record_llm_usage(stage, len(prompt), response_chars, usage)
+
+def pick_local_positions(track_store, user_request, count, exclude=()):
+    """До count номеров треков, подобранных локальным поиском без LLM; треки из exclude пропускаются."""
+    exclude = set(exclude)
+    limit = count + len(exclude)
+    if len(track_store) > limit:
+        positions = track_store.select_candidates(user_request, limit)
+    else:
+        positions = random.sample(range(len(track_store)), len(track_store))
+    return [position for position in positions if position not in exclude][:count]
+
+def build_fallback_speech(selected_sheet_name, user_request, user_name, lang_code):
+    return PROMPT_TEMPLATES[lang_code]['fallback_speech'].format(
+        user_name=user_name,
+        user_request=user_request,
+        selected_sheet_name=selected_sheet_name
+    )
+
+def build_fallback_block(track_store, selected_sheet_name, user_request, user_name, lang_code):
+    """Дешёвый блок без LLM: треки отбираются локальным поиском, подводка — по шаблону.
+    Возвращает (список деталей треков, speechText)."""
+    positions = pick_local_positions(track_store, user_request, RADIO_BLOCK_SIZE)
+    details = track_store.details(lang_code)
+    return [details[position] for position in positions], build_fallback_speech(selected_sheet_name, user_request, user_name, lang_code)
+
+def is_full_block(track_store, positions, speech_text, complete):
+    """Блок целиком собран AI: ответ не оборван, подводка есть и треков хватает на блок (ремонт не нужен)."""
+    return complete and bool(speech_text) and len(positions) >= min(RADIO_BLOCK_SIZE, len(track_store))
+
+def repair_block(track_store, selected_sheet_name, user_request, user_name, lang_code, positions, speech_text, complete):
+    """Дочинивает неполный ответ этапа 2 без повторного вызова LLM: валидные ID остаются,
+    недостающие до RADIO_BLOCK_SIZE треки добираются локальным поиском, а пустая или оборванная
+    (complete=False) подводка заменяется шаблонной. Возвращает (позиции, speechText, был ли ремонт)."""
+    repaired = False
+    wanted = min(RADIO_BLOCK_SIZE, len(track_store))
+    if len(positions) < wanted:
+        positions = positions + pick_local_positions(track_store, user_request, wanted - len(positions), exclude=positions)
+        repaired = True
+    if not speech_text or not complete:
+        speech_text = build_fallback_speech(selected_sheet_name, user_request, user_name, lang_code)
+        repaired = True
+    return positions, speech_text, repaired
+
+
+# --- Пул заранее сгенерированных блоков ---
+def is_default_request(user_request):
+    """Пустой запрос или «удиви меня» на любом из языков — слушателю всё равно, что играть."""
+    normalized = normalize_request(user_request)
+    return not normalized or normalized in DEFAULT_REQUESTS
+
+DEFAULT_REQUESTS = {normalize_request(templates['default_request']) for templates in PROMPT_TEMPLATES.values()}
+
+
+class BlockPool:
+    """Готовые блоки (позиции треков + подводка с заглушками имени и пожелания) по (плейлист, язык).
+    Каждый блок выдаётся не больше BLOCK_POOL_MAX_USES раз; при смене версии библиотеки пул очищается."""
+
+    def __init__(self, size, max_uses):
+        self.size = size
+        self.max_uses = max_uses
+        self._blocks = {} # {(лист, язык): deque([блок, осталось выдач])}
+        self._lock = threading.Lock()
+
+    def needs(self, sheet_name, lang_code):
+        with self._lock:
+            return len(self._blocks.get((sheet_name, lang_code), ())) < self.size
+
+    def add(self, sheet_name, lang_code, block):
+        with self._lock:
+            self._blocks.setdefault((sheet_name, lang_code), deque()).append([block, self.max_uses])
+
+    def take(self, snapshot, sheet_name, lang_code):
+        with self._lock:
+            queue = self._blocks.get((sheet_name, lang_code))
+            while queue:
+                entry = queue[0]
+                if entry[0]['version'] != snapshot.version:
+                    queue.popleft()
+                    continue
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    queue.popleft()
+                return entry[0]
+            return None
+
+    def peek(self, snapshot, sheet_name, lang_code):
+        """Готовые блоки листа без расходования выдач — для общего радиопотока, который не должен
+        отнимать блоки у слушателей /get-radio-play и заставлять пул лишний раз звать Gemini."""
+        with self._lock:
+            queue = self._blocks.get((sheet_name, lang_code), ())
+            return [entry[0] for entry in queue if entry[0]['version'] == snapshot.version]
+
+    def take_any(self, snapshot, lang_code):
+        """Блок случайного плейлиста с готовыми блоками на этом языке. Возвращает (лист, блок) или (None, None)."""
+        with self._lock:
+            candidates = [sheet for (sheet, lang), queue in self._blocks.items() if lang == lang_code and queue]
+        random.shuffle(candidates)
+        for sheet_name in candidates:
+            block = self.take(snapshot, sheet_name, lang_code)
+            if block:
+                return sheet_name, block
+        return None, None
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+
+    def stats(self):
+        with self._lock:
+            return {f"{sheet}/{lang}": len(queue) for (sheet, lang), queue in self._blocks.items()}
+
+
+BLOCK_POOL = BlockPool(BLOCK_POOL_SIZE, BLOCK_POOL_MAX_USES)
+_block_pool_started = False
+
+def generate_pool_block(snapshot, sheet_name, lang_code):
+    """Генерирует один блок для пула обычным промптом этапа 2 с заглушками вместо имени и пожелания."""
+    track_store, prompt_stage2 = prepare_stage2(snapshot, sheet_name, REQUEST_PLACEHOLDER, LISTENER_NAME_PLACEHOLDER, lang_code)
+    raw_text = generate_with_deadline(prompt_stage2, STAGE2_TIMEOUT, 'pool', STAGE2_RESPONSE_CONFIG).text or ""
+    positions, speech_template, complete, _ = parse_stage2_block(track_store, raw_text)
+    if not complete or not positions or not speech_template:
+        return None # В пул попадают только блоки, целиком собранные AI
+    return {"positions": positions, "speechText": speech_template, "version": snapshot.version}
+
+def _block_pool_loop():
+    while True:
+        time.sleep(BLOCK_POOL_REFILL_INTERVAL)
+        snapshot = LIBRARY_SNAPSHOT
+        if snapshot is None or llm_load() >= BLOCK_POOL_IDLE_LOAD:
+            continue # Пополняем только в спокойное время
+        for sheet_name in snapshot.metadata:
+            if sheet_name not in snapshot.stores or not snapshot.stores[sheet_name].tracks:
+                continue
+            lang_code = next((code for code in BLOCK_POOL_LANGUAGES if code in PROMPT_TEMPLATES
+                              and BLOCK_POOL.needs(sheet_name, code)), None)
+            if lang_code is None:
+                continue
+            try:
+                block = generate_pool_block(snapshot, sheet_name, lang_code)
+                if block:
+                    BLOCK_POOL.add(sheet_name, lang_code, block)
+            except Exception as e:
+                logger.warning("Ошибка при генерации блока для пула ('%s', %s): %s", sheet_name, lang_code, e)
+            break # Не больше одного вызова Gemini за цикл
+
+def start_block_pool_worker():
+    """Запускает фоновое пополнение пула готовых блоков (один раз на процесс)."""
+    global _block_pool_started
+    if _block_pool_started or not client or BLOCK_POOL_SIZE <= 0:
+        return
+    _block_pool_started = True
+    threading.Thread(target=_block_pool_loop, name="block-pool", daemon=True).start()
+
+
+# --- Потоковый разбор ответа этапа 2 ---
+class RadioPlayError(Exception):
+    """Ошибка подготовки радио-блока, которую нужно отдать клиенту с HTTP-статусом."""
+
+    def __init__(self, message, status=500):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class StreamingBlockParser:
+    """Инкрементальный однопроходный разбор JSON вида {"playlist": [...], "speechText": "..."}.
+    feed() принимает очередной кусок текста модели и возвращает события ('track', id) по мере
+    закрытия элементов массива playlist и ('speech', фрагмент) по мере генерации speechText.
+    Текст до первой '{' (например, ```json) игнорируется, обрыв ответа не ломает уже найденное."""
+
+    ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 'b': '\b', 'f': '\f', '/': '/', '\\': '\\', '"': '"'}
+
+    def __init__(self):
+        self.depth = 0
+        self.done = False
+        self.current_key = None
+        self.awaiting_key = False
+        self.awaiting_value = False
+        self.in_playlist = False
+        self.in_string = False
+        self.string_role = None # 'key' | 'track' | 'speech' | None
+        self.string_chars = []
+        self.escape = False
+        self.unicode_digits = None
+        self.high_surrogate = None
+        self.scalar_chars = []
+        self.track_ids = []
+        self.speech_parts = []
+
+    @property
+    def speech_text(self):
+        return "".join(self.speech_parts)
+
+    def result(self):
+        return {"playlist": list(self.track_ids), "speechText": self.speech_text}
+
+    def feed(self, text):
+        events = []
+        speech_delta = []
+        for char in text:
+            if self.done:
+                break
+            if self.in_string:
+                self._feed_string_char(char, events, speech_delta)
+                continue
+            if self.depth == 0:
+                if char == '{':
+                    self.depth = 1
+                    self.awaiting_key = True
+                continue
+            if char == '"':
+                self._start_string()
+            elif char == '{':
+                self.depth += 1
+            elif char == '[':
+                self.depth += 1
+                if self.depth == 2 and self.awaiting_value and self.current_key == 'playlist':
+                    self.in_playlist = True
+                    self.awaiting_value = False
+            elif char in ']}':
+                self._flush_scalar(events)
+                if char == ']' and self.in_playlist and self.depth == 2:
+                    self.in_playlist = False
+                self.depth -= 1
+                if self.depth == 0:
+                    self.done = True
+            elif char == ':':
+                if self.depth == 1:
+                    self.awaiting_key = False
+                    self.awaiting_value = True
+            elif char == ',':
+                self._flush_scalar(events)
+                if self.depth == 1:
+                    self.awaiting_key = True
+                    self.awaiting_value = False
+            elif char.isspace():
+                self._flush_scalar(events)
+            elif self.in_playlist and self.depth == 2:
+                # ID без кавычек (например, числа)
+                self.scalar_chars.append(char)
+        if speech_delta:
+            events.append(('speech', "".join(speech_delta)))
+        return events
+
+    def _start_string(self):
+        self.in_string = True
+        self.string_chars = []
+        if self.depth == 1 and self.awaiting_key:
+            self.string_role = 'key'
+        elif self.depth == 1 and self.awaiting_value and self.current_key == 'speechText':
+            self.string_role = 'speech'
+        elif self.in_playlist and self.depth == 2:
+            self.string_role = 'track'
+        else:
+            self.string_role = None
+        if self.depth == 1:
+            self.awaiting_value = False
+
+    def _feed_string_char(self, char, events, speech_delta):
+        if self.unicode_digits is not None:
+            self.unicode_digits.append(char)
+            if len(self.unicode_digits) == 4:
+                try:
+                    code_point = int("".join(self.unicode_digits), 16)
+                except ValueError:
+                    code_point = 0xFFFD
+                self.unicode_digits = None
+                if 0xD800 <= code_point < 0xDC00:
+                    self.high_surrogate = code_point
+                    return
+                if 0xDC00 <= code_point < 0xE000 and self.high_surrogate is not None:
+                    code_point = 0x10000 + ((self.high_surrogate - 0xD800) << 10) + (code_point - 0xDC00)
+                self.high_surrogate = None
+                self._append_string_char(chr(code_point), speech_delta)
+            return
+        if self.escape:
+            self.escape = False
+            if char == 'u':
+                self.unicode_digits = []
+            else:
+                self._append_string_char(self.ESCAPES.get(char, char), speech_delta)
+            return
+        if char == '\\':
+            self.escape = True
+        elif char == '"':
+            self.in_string = False
+            value = "".join(self.string_chars)
+            if self.string_role == 'key':
+                self.current_key = value
+            elif self.string_role == 'track':
+                self._emit_track(value, events)
+        else:
+            self._append_string_char(char, speech_delta)
+
+    def _append_string_char(self, char, speech_delta):
+        if self.string_role == 'speech':
+            self.speech_parts.append(char)
+            speech_delta.append(char)
+        else:
+            self.string_chars.append(char)
+
+    def _flush_scalar(self, events):
+        if self.scalar_chars:
+            self._emit_track("".join(self.scalar_chars), events)
+            self.scalar_chars = []
+
+    def _emit_track(self, value, events):
+        value = value.strip()
+        if value:
+            self.track_ids.append(value)
+            events.append(('track', value))
+
+
+# --- Общий непрерывный радиопоток ---
+class ChunkRing:
+    """Кольцевой буфер кусков mp3 с порядковыми номерами: один писатель (станция) и сколько угодно читателей.
+    Слушатель хранит только номер следующего куска, поэтому его стоимость не зависит от числа остальных."""
+
+    def __init__(self, capacity):
+        self.chunks = deque(maxlen=capacity)
+        self.next_seq = 0 # Номер куска, который будет записан следующим
+        self.closed = False
+        self._cond = threading.Condition()
+
+    def append(self, chunk):
+        with self._cond:
+            self.chunks.append(chunk)
+            self.next_seq += 1
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def start_seq(self, prebuffer_chunks):
+        """С какого куска начинать новому слушателю: немного из уже накопленного, чтобы плеер сразу заиграл."""
+        with self._cond:
+            return self.next_seq - min(prebuffer_chunks, len(self.chunks))
+
+    def read(self, seq, timeout):
+        """Кусок с номером seq (или самый старый из оставшихся, если слушатель отстал больше чем на весь буфер).
+        Возвращает (кусок, номер следующего) или (None, seq), если за timeout ничего нового не появилось."""
+        with self._cond:
+            if seq >= self.next_seq and not self.closed:
+                self._cond.wait(timeout)
+            if seq >= self.next_seq:
+                return None, seq
+            first_seq = self.next_seq - len(self.chunks)
+            seq = max(seq, first_seq)
+            return self.chunks[seq - first_seq], seq + 1
+
+
+def open_track_audio(music_url):
+    """Открывает mp3 трека для общего потока: файл из static/music с тем же именем, что в music_url,
+    иначе сам music_url по HTTP. Возвращает объект с read() или None."""
+    url = str(music_url or '').strip()
+    if not url:
+        return None
+    local_path = os.path.join(MUSIC_DIR, os.path.basename(urllib.parse.urlparse(url).path))
+    if os.path.isfile(local_path):
+        return open(local_path, 'rb')
+    if url.startswith(('http://', 'https://')):
+        return urllib.request.urlopen(url, timeout=AUDIO_FETCH_TIMEOUT)
+    return None
+
+
+class RadioStation:
+    """Общий поток одного плейлиста. Фоновый поток берёт очередной блок (готовый блок AI из пула, не расходуя его,
+    иначе локальную подборку), читает mp3 его треков в темпе RADIO_STREAM_BITRATE и пишет в ChunkRing,
+    из которого читают все слушатели. Без слушателей дольше RADIO_STREAM_IDLE_TIMEOUT станция останавливается."""
+
+    def __init__(self, sheet_name, lang_code):
+        self.sheet_name = sheet_name
+        self.lang_code = lang_code
+        self.bytes_per_second = RADIO_STREAM_BITRATE * 1000 / 8
+        self.ring = ChunkRing(max(1, int(RADIO_STREAM_BUFFER_SECONDS * self.bytes_per_second / RADIO_STREAM_CHUNK_BYTES)))
+        self.listeners = 0 # Меняется только под RADIO_STATIONS_LOCK
+        self.idle_since = time.monotonic()
+        self.now_playing = None
+        self.last_block = None # Последний сыгранный блок из пула, чтобы не повторять его подряд
+        self.thread = threading.Thread(target=self._run, name=f"radio-station-{sheet_name}", daemon=True)
+
+    def next_block(self):
+        """(TrackStore, позиции треков) следующего блока или (None, None), если листа больше нет."""
+        snapshot = LIBRARY_SNAPSHOT
+        track_store = snapshot.stores.get(self.sheet_name) if snapshot else None
+        if not track_store or not track_store.tracks:
+            return None, None
+        blocks = [block for block in BLOCK_POOL.peek(snapshot, self.sheet_name, self.lang_code) if block is not self.last_block]
+        if blocks:
+            self.last_block = random.choice(blocks)
+            return track_store, self.last_block['positions']
+        self.last_block = None
+        default_request = PROMPT_TEMPLATES[self.lang_code]['default_request']
+        return track_store, pick_local_positions(track_store, default_request, RADIO_BLOCK_SIZE)
+
+    def should_stop(self):
+        with RADIO_STATIONS_LOCK:
+            if self.listeners > 0 or time.monotonic() - self.idle_since < RADIO_STREAM_IDLE_TIMEOUT:
+                return False
+            # Снимаем станцию под тем же замком, под которым подключаются слушатели
+            if RADIO_STATIONS.get((self.sheet_name, self.lang_code)) is self:
+                del RADIO_STATIONS[(self.sheet_name, self.lang_code)]
+            return True
+
+    def _run(self):
+        try:
+            self._broadcast()
+        except Exception:
+            logger.exception("Поток '%s' остановлен из-за ошибки", self.sheet_name)
+        finally:
+            # Как бы ни закончилось вещание, станцию снимаем, а слушателей отпускаем —
+            # следующее подключение запустит новую
+            with RADIO_STATIONS_LOCK:
+                if RADIO_STATIONS.get((self.sheet_name, self.lang_code)) is self:
+                    del RADIO_STATIONS[(self.sheet_name, self.lang_code)]
+            self.ring.close()
+
+    def _broadcast(self):
+        started = time.monotonic()
+        sent_bytes = 0
+        while not self.should_stop():
+            track_store, positions = self.next_block()
+            if track_store is None:
+                break
+            played = 0
+            for position in positions:
+                if self.should_stop():
+                    break
+                music_url = track_store.tracks[position].get('music_url')
+                try:
+                    source = open_track_audio(music_url)
+                    if source is None:
+                        continue
+                    self.now_playing = track_store.details(self.lang_code)[position]
+                    with source:
+                        while not self.should_stop():
+                            chunk = source.read(RADIO_STREAM_CHUNK_BYTES)
+                            if not chunk:
+                                break
+                            self.ring.append(chunk)
+                            # Темп реального времени: в буфере «эфир», а не весь файл сразу
+                            sent_bytes += len(chunk)
+                            delay = started + sent_bytes / self.bytes_per_second - time.monotonic()
+                            if delay > 0:
+                                time.sleep(delay)
+                            elif delay < -1:
+                                started -= delay # Источник тормозил — не наверстываем рывком
+                    played += 1
+                except Exception as e:
+                    logger.warning("Ошибка чтения трека '%s' для потока '%s': %s", music_url, self.sheet_name, e)
+            if not played:
+                time.sleep(1) # Ни один трек блока не открылся — не крутимся вхолостую
+
+
+RADIO_STATIONS = {} # {(лист, язык): RadioStation}
+RADIO_STATIONS_LOCK = threading.Lock()
+
+def listen_radio_station(sheet_name, lang_code):
+    """mp3-поток для одного слушателя. Слушатель учитывается только пока генератор реально читается,
+    поэтому оборванные и так и не начатые ответы не держат станцию."""
+    with RADIO_STATIONS_LOCK:
+        station = RADIO_STATIONS.get((sheet_name, lang_code))
+        if station is None or not station.thread.is_alive() or station.ring.closed:
+            station = RadioStation(sheet_name, lang_code)
+            RADIO_STATIONS[(sheet_name, lang_code)] = station
+            station.thread.start()
+        station.listeners += 1
+    STREAM_LISTENERS.inc(sheet=sheet_name)
+    seq = station.ring.start_seq(int(RADIO_STREAM_PREBUFFER_SECONDS * station.bytes_per_second / RADIO_STREAM_CHUNK_BYTES))
+    try:
+        while True:
+            chunk, seq = station.ring.read(seq, timeout=5)
+            if chunk is not None:
+                yield chunk
+            elif station.ring.closed:
+                return
+    finally:
+        with RADIO_STATIONS_LOCK:
+            station.listeners -= 1
+            if not station.listeners:
+                station.idle_since = time.monotonic()
+
+def radio_stations_stats():
+    with RADIO_STATIONS_LOCK:
+        stations = list(RADIO_STATIONS.values())
+    return [{
+        "sheet": station.sheet_name,
+        "language": station.lang_code,
+        "listeners": station.listeners,
+        "nowPlaying": station.now_playing
+    } for station in stations]
+
+
+# --- API ЭНДПОИНТЫ ---
+def serialize_response(payload):
+    """jsonify с замером времени сериализации (на больших библиотеках это заметная часть запроса)."""
+    with timed('serialize'):
+        return jsonify(payload)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_duration(response):
+    started = g.get('request_started')
+    if started is not None:
+        # Для SSE это время до начала потока, а не до его конца
+        REQUEST_DURATION.observe(time.perf_counter() - started,
+                                 endpoint=request.url_rule.rule if request.url_rule else 'unknown',
+                                 status=response.status_code)
+    return response
+
+
+@app.route('/')
+def index():
+    return "Flask-сервер для AI Радио работает! Метаданные плейлистов загружены: " + ("Да" if PLAYLIST_METADATA else "Нет")
+
+PLAYLIST_FIELDS = ("title", "artist", "musicUrl", "mood", "description") # Поля трека, доступные для ?fields=
+
+def choose_encoding():
+    """Лучшая поддерживаемая клиентом кодировка сжатия: br (если установлен brotli), gzip или None."""
+    if brotli is not None and request.accept_encodings['br']:
+        return 'br'
+    if request.accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+def encode_body(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=5) # Максимальное качество слишком медленное для ответа на лету
+    return gzip.compress(body, compresslevel=6)
+
+def versioned_json_response(cache_key, etag, build_payload):
+    """JSON-ответ, который зависит только от версии библиотеки и параметров запроса.
+    Поддерживает If-None-Match (304), сжимает тело и кэширует готовые байты для каждой кодировки."""
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        encoding = choose_encoding()
+        cached = ENCODED_BODIES.get(cache_key + (encoding,))
+        if cached is None:
+            with timed('serialize'):
+                body = json.dumps(build_payload(), ensure_ascii=False).encode('utf-8')
+            used_encoding = None
+            if encoding and len(body) >= COMPRESSION_MIN_BYTES:
+                with timed('compress'):
+                    body = encode_body(body, encoding)
+                used_encoding = encoding
+            cached = (used_encoding, body)
+            ENCODED_BODIES.put(cache_key + (encoding,), cached, size=len(body))
+        used_encoding, body = cached
+        response = Response(body, mimetype='application/json')
+        if used_encoding:
+            response.headers['Content-Encoding'] = used_encoding
+    response.set_etag(etag, weak=True) # Слабый: сжатое и несжатое тела эквивалентны по смыслу
+    response.headers['Cache-Control'] = 'no-cache' # Браузер хранит ответ, но каждый раз сверяет ETag
+    response.vary.add('Accept-Encoding')
+    return response
+
+def parse_playlist_page_args(snapshot, total):
+    """Разбирает cursor, limit и fields для /get-full-playlist. Возвращает (offset, limit, fields), limit=None — до конца.
+    Курсор привязан к версии библиотеки: после её обновления страницы пришлось бы начинать сначала."""
+    cursor = request.args.get('cursor')
+    limit = request.args.get('limit')
+    offset = 0
+    if cursor:
+        version, _, position = cursor.partition('.')
+        if not position.isdigit():
+            raise RadioPlayError("Неверный курсор.", 400)
+        if version != snapshot.version:
+            raise RadioPlayError("Библиотека обновилась, начните загрузку с первой страницы.", 409)
+        offset = min(int(position), total)
+    if limit is not None:
+        if not limit.isdigit() or int(limit) < 1:
+            raise RadioPlayError("Параметр limit должен быть положительным числом.", 400)
+        limit = min(int(limit), FULL_PLAYLIST_PAGE_LIMIT)
+    elif cursor:
+        limit = FULL_PLAYLIST_PAGE_LIMIT
+    fields = None
+    if request.args.get('fields'):
+        fields = tuple(field.strip() for field in request.args['fields'].split(',') if field.strip())
+        unknown = [field for field in fields if field not in PLAYLIST_FIELDS]
+        if unknown:
+            raise RadioPlayError(f"Неизвестные поля: {', '.join(unknown)}. Доступны: {', '.join(PLAYLIST_FIELDS)}.", 400)
+    return offset, limit, fields
+
+@app.route('/get-full-playlist', methods=['GET'])
+def get_full_playlist_route():
+    """Треки листа (по умолчанию основного) на нужном языке.
+    Необязательные параметры: sheet, cursor и limit — постраничная выдача, fields — только перечисленные поля.
+    Без cursor и limit отдаётся весь лист, как раньше. Ответ помечен ETag по версии библиотеки."""
+    snapshot = get_library_snapshot()
+    if snapshot is None:
+        return jsonify({"error": "Сервис Google Sheets не инициализирован."}), 500
+
+    lang_code = request.args.get('language', 'ru').lower() # Получаем язык из query params
+
+    # Берём первый лист, который есть в метаданных, как основной,
+    # или просто первый лист с треками, если метаданные пусты
+    target_sheet_title = request.args.get('sheet') or snapshot.default_sheet_name()
+    if not target_sheet_title:
+        return jsonify({"error": "В таблице нет листов с треками (кроме, возможно, мета-листа)."}), 500
+
+    track_store = snapshot.stores.get(target_sheet_title)
+    if not track_store:
+        return jsonify({"error": "Библиотека музыки пуста или не удалось загрузить треки"}), 404
+
+    try:
+        offset, limit, fields = parse_playlist_page_args(snapshot, len(track_store))
+    except RadioPlayError as e:
+        return jsonify({"error": e.message}), e.status
+
+    def build_payload():
+        details = track_store.details(lang_code)
+        end = len(details) if limit is None else min(offset + limit, len(details))
+        page = details[offset:end]
+        if fields:
+            page = [{field: track_details.get(field) for field in fields} for track_details in page]
+        return {
+            "playlist": page,
+            "sheet": target_sheet_title,
+            "version": snapshot.version,
+            "total": len(details),
+            "nextCursor": f"{snapshot.version}.{end}" if end < len(details) else None
+        }
+
+    cache_key = ('full_playlist', snapshot.version, target_sheet_title, lang_code, offset, limit, fields)
+    params_hash = hashlib.sha1(repr(cache_key[2:]).encode('utf-8')).hexdigest()[:10]
+    return versioned_json_response(cache_key, f"{snapshot.version}-{params_hash}", build_payload)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_route():
+    """Метрики в формате Prometheus. Под gunicorn у каждого воркера свои значения."""
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats_route():
+    """Счётчики попаданий и промахов кэша ответов AI."""
+    return jsonify({
+        "responses": RESPONSE_CACHE.stats(),
+        "promptFragments": len(PROMPT_FRAGMENTS),
+        "blockPool": BLOCK_POOL.stats(),
+        "encodedBodies": ENCODED_BODIES.stats(),
+        "radioStations": radio_stations_stats(),
+        "libraryVersion": LIBRARY_SNAPSHOT.version if LIBRARY_SNAPSHOT else None
+    })
+
+
+@app.route('/audio/<path:filename>', methods=['GET'])
+def audio_route(filename):
+    """Локальный mp3 из static/music с поддержкой Range (перемотка и докачка), ETag/Last-Modified и долгим кэшем.
+    Целый файл уходит через wsgi.file_wrapper, который gunicorn отдаёт через sendfile без копирования в память."""
+    return send_from_directory(MUSIC_DIR, filename, conditional=True, max_age=AUDIO_CACHE_MAX_AGE)
+
+
+@app.route('/radio-stream/<sheet_name>', methods=['GET'])
+def radio_stream_route(sheet_name):
+    """Общий непрерывный mp3-поток плейлиста (как у Icecast): все слушатели читают один кольцевой буфер.
+    Каждый слушатель занимает поток gunicorn, поэтому режим включается явно через RADIO_STREAM_ENABLED."""
+    if not RADIO_STREAM_ENABLED:
+        return jsonify({"error": "Общий радиопоток выключен (RADIO_STREAM_ENABLED)."}), 404
+    snapshot = get_library_snapshot()
+    if snapshot is None or sheet_name not in snapshot.stores:
+        return jsonify({"error": f"Плейлист с названием '{sheet_name}' не найден в таблице."}), 404
+    lang_code = request.args.get('language', 'ru').lower()
+    if lang_code not in PROMPT_TEMPLATES:
+        lang_code = 'ru'
+    return Response(listen_radio_station(sheet_name, lang_code), mimetype='audio/mpeg',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/refresh-library', methods=['POST'])
+def refresh_library_route():
+    """Ручное обновление снимка библиотеки из Google Sheets. Доступно только при заданном LIBRARY_REFRESH_TOKEN:
+    каждый вызов стоит 1+N чтений Sheets, поэтому открытым для всех его оставлять нельзя."""
+    if not LIBRARY_REFRESH_TOKEN:
+        return jsonify({"error": "Ручное обновление выключено: не задан LIBRARY_REFRESH_TOKEN."}), 404
+    if not hmac.compare_digest(request.headers.get('X-Refresh-Token', '').encode(), LIBRARY_REFRESH_TOKEN.encode()):
+        return jsonify({"error": "Неверный токен обновления."}), 403
+
+    global _last_refresh_attempt
+    previous_version = LIBRARY_SNAPSHOT.version if LIBRARY_SNAPSHOT else None
+    _last_refresh_attempt = time.time()
+    try:
+        # Не через refresh_library(): та при ошибке молча отдаёт старый снимок, а здесь о сбое нужно сообщить
+        snapshot = LIBRARY_FLIGHTS.do('library', _reload_library)
+    except Exception as e:
+        logger.error("Ручное обновление библиотеки не удалось: %s", e)
+        return jsonify({"error": f"Не удалось обновить музыкальную библиотеку: {e}"}), 502
+    return jsonify({
+        "version": snapshot.version,
+        "changed": snapshot.version != previous_version,
+        "playlists": len(snapshot.metadata),
+        "sheets": len(snapshot.sheets),
+        "loadedAt": snapshot.loaded_at
+    })
+
+
+def parse_radio_request():
+    """Достаёт из тела запроса пожелание, имя слушателя и язык. Бросает RadioPlayError при неверном JSON."""
+    try:
+        data = request.get_json(force=True)
+        user_request = data.get('request', 'удиви меня')
+        user_name = data.get('userName', 'слушатель')
+        lang_code = data.get('language', 'ru').lower()
+        if lang_code not in PROMPT_TEMPLATES:
+            logger.info("Неподдерживаемый код языка '%s'. Используется 'ru'.", lang_code)
+            lang_code = 'ru'
+    except Exception as e:
+        logger.info("Ошибка получения JSON из запроса: %s", e)
+        raise RadioPlayError("Неверный формат запроса. Ожидается JSON.", 400)
+    return user_request, user_name, lang_code
+
+def get_radio_snapshot():
+    """Снимок библиотеки для /get-radio-play*, если сервер готов обслуживать AI-запросы."""
+    snapshot = get_library_snapshot()
+    if not client or snapshot is None:
+        raise RadioPlayError("Сервер не настроен должным образом (проблема с Google Sheets или Gemini API).", 500)
+    if not snapshot.metadata:
+        raise RadioPlayError(f"Метаданные плейлистов не загружены. Проверьте лист '{PLAYLIST_METADATA_SHEET_NAME}'.", 500)
+    return snapshot
+
+def prepare_stage2(snapshot, selected_sheet_name, user_request, user_name, lang_code):
+    """Находит треки выбранного листа и собирает промпт этапа 2. Возвращает (TrackStore, промпт)."""
+    with timed('stage2_prompt'):
+        return _prepare_stage2(snapshot, selected_sheet_name, user_request, user_name, lang_code)
+
+def _prepare_stage2(snapshot, selected_sheet_name, user_request, user_name, lang_code):
+    if selected_sheet_name not in snapshot.sheets:
+        raise RadioPlayError(f"Плейлист с названием '{selected_sheet_name}' не найден в таблице.", 404)
+    track_store = snapshot.stores[selected_sheet_name]
+    if not track_store.tracks:
+        raise RadioPlayError(f"Плейлист '{selected_sheet_name}' пуст или не удалось загрузить треки.", 500)
+
+    library_description = build_library_description(snapshot, track_store, user_request, lang_code)
 
     prompt_stage2_template = PROMPT_TEMPLATES[lang_code]['stage2']
     prompt_stage2 = prompt_stage2_template.format(
@@ -354,56 +1947,367 @@ def get_radio_play():
         user_request=user_request,
         library_description=library_description
     )
+    return track_store, prompt_stage2
 
-    raw_text = ""
+def extract_stage2_json(raw_text):
+    """Разбирает ответ этапа 2 и никогда не бросает исключений.
+    Возвращает (данные, complete): complete=False, если ответ оборван и данные восстановлены частично."""
+    with timed('json_extract'):
+        return _extract_stage2_json(raw_text)
+
+def _extract_stage2_json(raw_text):
+    text = (raw_text or "").strip()
     try:
-        print(f"\n--- Промпт для Этапа 2 (плейлист: {selected_sheet_name}, язык: {lang_code}) ---\n{prompt_stage2}\n----------------------------")
-        response_stage2 = client.models.generate_content(model="gemini-2.5-flash", contents=prompt_stage2)  # <-- ИСПРАВЛЕНО
-        raw_text = response_stage2.text
-
-        json_text_match = re.search(r"```json\s*([\s\S]*?)\s*```|({[\s\S]*})", raw_text)
-        if json_text_match:
-            json_text = json_text_match.group(1) or json_text_match.group(2)
-            json_text = json_text.strip()
+        data = json.loads(text) # Обычный случай при ответе по схеме: ровно один JSON-объект
+        if isinstance(data, dict):
+            return _coerce_stage2_data(data)
+    except ValueError:
+        pass
+    # Один проход по тексту: переживает ```json, текст вокруг объекта и обрыв посреди ответа
+    parser = StreamingBlockParser()
+    parser.feed(text)
+    return parser.result(), parser.done
+
+def _coerce_stage2_data(data):
+    """Приводит разобранный JSON к {"playlist": [str], "speechText": str}.
+    Если типы пришлось исправлять, ответ считается неполным (complete=False) и пойдёт в repair_block."""
+    complete = True
+    playlist = data.get('playlist')
+    if isinstance(playlist, str):
+        playlist = [track_id for track_id in re.split(r"[,;\s]+", playlist) if track_id] # "1-1, 1-2"
+        complete = False
+    elif not isinstance(playlist, list):
+        playlist = []
+        complete = False
+    track_ids = [str(track_id) for track_id in playlist
+                 if isinstance(track_id, (str, int, float)) and not isinstance(track_id, bool)]
+    if len(track_ids) != len(playlist):
+        complete = False
+    speech_text = data.get('speechText')
+    if not isinstance(speech_text, str):
+        speech_text = ""
+        complete = False
+    return {"playlist": track_ids, "speechText": speech_text}, complete
+
+def parse_stage2_block(track_store, raw_text):
+    """Ответ этапа 2 в виде (позиции треков, шаблон подводки, complete, ID, которых нет в листе)."""
+    ai_data, complete = extract_stage2_json(raw_text)
+    positions = []
+    missing_ids = []
+    for track_id_input in ai_data.get('playlist') or []:
+        position = track_store.find_index(track_id_input)
+        if position is None:
+            missing_ids.append(str(track_id_input).strip())
         else:
-            json_text = raw_text.strip()
-            if not json_text.startswith('{') and '{' in json_text:
-                json_text = json_text[json_text.find('{'):]
-            if not json_text.endswith('}') and '}' in json_text:
-                json_text = json_text[:json_text.rfind('}')+1]
-
-        ai_data = json.loads(json_text)
-        playlist_ids_from_ai = ai_data.get('playlist', [])
-        speech_text = ai_data.get('speechText', "Что-то пошло не так с генерацией текста...")
-
-        # Формируем плейлист с полными данными треков
-        selected_playlist_tracks = []
-        for track_id_input in playlist_ids_from_ai:
-            track_id_str = str(track_id_input).strip()
-            # Ищем трек по ID в загруженных данных
-            track_data = next((t for t in all_tracks_from_selected_sheet if str(t.get('id')).strip() == track_id_str), None)
-            if track_data:
-                selected_playlist_tracks.append(get_track_details_for_playlist(track_data, lang_code))
-            else:
-                print(f"Предупреждение: Трек с ID '{track_id_str}' не найден в плейлисте '{selected_sheet_name}'.")
+            positions.append(position)
+    return positions, ai_data.get('speechText') or "", complete, missing_ids
 
-        # Формируем полный плейлист из выбранного листа для клиента
-        full_playlist_from_sheet = [get_track_details_for_playlist(track, lang_code) for track in all_tracks_from_selected_sheet]
+def remember_stage2_block(stage2_cache_key, track_store, speech_template, positions, complete):
+    """Кладёт блок в кэш ответов, если он целиком собран AI. Вызывается только ведущим запросом
+    single-flight, чтобы одна генерация давала один вариант, а не по варианту на каждого дождавшегося."""
+    if is_full_block(track_store, positions, speech_template, complete):
+        RESPONSE_CACHE.add_variant(stage2_cache_key, {"positions": positions, "speechText": speech_template},
+                                   RESPONSE_CACHE_VARIANTS)
 
-        final_response = {
-            "speechText": speech_text,
-            "playlist": selected_playlist_tracks, # Треки, выбранные AI
-            "full_playlist_from_sheet": full_playlist_from_sheet # Все треки из выбранного AI листа
-        }
-        return jsonify(final_response)
+def generate_stage2_text(stage2_cache_key, track_store, prompt_stage2):
+    """Вызов Gemini этапа 2 для ведущего запроса AI_FLIGHTS: текст ответа, удачный блок сразу идёт в кэш."""
+    # Без текста (блокировка безопасности, пустые кандидаты, бюджет ушёл на размышления) — пустая строка, её дочинит repair_block
+    raw_text = generate_with_deadline(prompt_stage2, STAGE2_TIMEOUT, 'stage2', STAGE2_RESPONSE_CONFIG).text or ""
+    positions, speech_template, complete, _ = parse_stage2_block(track_store, raw_text)
+    remember_stage2_block(stage2_cache_key, track_store, speech_template, positions, complete)
+    return raw_text
+
+def full_playlist_fields(snapshot, track_store, lang_code):
+    """Весь выбранный лист для ответа /get-radio-play*. Если клиент прислал "fullPlaylist": false,
+    вместо него отдаются только версия библиотеки и название листа: сам лист клиент берёт
+    из /get-full-playlist?sheet=..., где он кэшируется по ETag."""
+    fields = {"libraryVersion": snapshot.version}
+    data = request.get_json(silent=True) or {}
+    if data.get('fullPlaylist', True) is False:
+        fields["sheet"] = track_store.sheet_name
+    else:
+        fields["full_playlist_from_sheet"] = track_store.details(lang_code)
+    return fields
+
+def ready_block_response(snapshot, track_store, block, user_name, user_request, lang_code, routing, **flags):
+    """Ответ /get-radio-play из готового блока (кэш ответов или пул): {"positions", "speechText"} с заглушками."""
+    BLOCKS_SERVED.inc(source='cache' if flags.get('cached') else 'pool')
+    details = track_store.details(lang_code)
+    response = {
+        "speechText": personalize_speech(block['speechText'], user_name, user_request),
+        "playlist": [details[position] for position in block['positions']],
+        "routing": routing
+    }
+    response.update(full_playlist_fields(snapshot, track_store, lang_code))
+    response.update(flags)
+    return response
+
+def resolve_track(track_store, track_id_input, lang_code):
+    """Детали трека по ID из ответа AI (из заранее собранных данных) или None, если такого ID нет."""
+    track_index = track_store.find_index(track_id_input)
+    if track_index is None:
+        logger.info("Трек с ID '%s' не найден в плейлисте '%s'.", str(track_id_input).strip(), track_store.sheet_name)
+        return None
+    return track_store.details(lang_code)[track_index]
+
+
+def stage2_response(snapshot, track_store, selected_sheet_name, raw_text, user_request, user_name, lang_code, routing):
+    """Ответ /get-radio-play по тексту этапа 2, сгенерированному с заглушкой имени.
+    Неполный или оборванный ответ дочиняется локально, а не превращается в 500 и повторный вызов Gemini."""
+    # Позиции треков из ответа AI; несуществующие ID пропускаются
+    selected_positions, speech_template, complete, missing_ids = parse_stage2_block(track_store, raw_text)
+    if missing_ids:
+        logger.info("Треки с ID %s не найдены в плейлисте '%s'.", missing_ids, selected_sheet_name)
+
+    selected_positions, speech_template, repaired = repair_block(
+        track_store, selected_sheet_name, user_request, LISTENER_NAME_PLACEHOLDER, lang_code,
+        selected_positions, speech_template, complete)
+    if repaired:
+        if not complete:
+            UPSTREAM_ERRORS.inc(upstream='gemini', stage='stage2', kind='bad_json')
+        FALLBACKS.inc(stage='stage2', reason='repaired')
+        logger.info("Ответ этапа 2 неполный, блок дочинен локально.")
+        logger.debug("Ответ от Gemini был: '%.500s'", raw_text)
+
+    BLOCKS_SERVED.inc(source='repaired' if repaired else 'llm')
+    details = track_store.details(lang_code)
+    response = {
+        "speechText": personalize_speech(speech_template, user_name),
+        "playlist": [details[position] for position in selected_positions], # Треки, выбранные AI
+        "routing": routing, # Как был выбран плейлист: local / llm / fallback
+        **full_playlist_fields(snapshot, track_store, lang_code) # Все треки из выбранного AI листа или версия библиотеки
+    }
+    if repaired:
+        response["repaired"] = True # Часть блока собрана без AI
+    return response
+
+def fallback_response(snapshot, track_store, selected_sheet_name, error, user_request, user_name, lang_code, routing):
+    """Ответ /get-radio-play без AI, когда этап 2 упал или не уложился в дедлайн."""
+    FALLBACKS.inc(stage='stage2', reason='timeout' if isinstance(error, UpstreamTimeout) else 'error')
+    BLOCKS_SERVED.inc(source='fallback')
+    fallback_tracks, fallback_speech = build_fallback_block(track_store, selected_sheet_name, user_request, user_name, lang_code)
+    return {
+        "speechText": fallback_speech,
+        "playlist": fallback_tracks,
+        "routing": routing,
+        "degraded": True, # Блок собран без AI
+        **full_playlist_fields(snapshot, track_store, lang_code)
+    }
+
+
+@app.route('/get-radio-play', methods=['POST'])
+def get_radio_play():
+    try:
+        snapshot = get_radio_snapshot()
+        user_request, user_name, lang_code = parse_radio_request()
+
+        # Запрос «на усмотрение диджея» — сразу отдаём готовый блок из пула, без обоих этапов
+        if is_default_request(user_request):
+            pooled_sheet_name, pooled_block = BLOCK_POOL.take_any(snapshot, lang_code)
+            if pooled_block:
+                return serialize_response(ready_block_response(snapshot, snapshot.stores[pooled_sheet_name], pooled_block,
+                                                              user_name, user_request, lang_code,
+                                                              {"path": "pool", "confidence": 1.0}, pooled=True))
+
+        # --- ЭТАП 1: AI ВЫБИРАЕТ ЛИСТ НА ОСНОВЕ МЕТАДАННЫХ ---
+        selected_sheet_name, routing = select_playlist(snapshot, user_request, lang_code)
+
+        # --- ЭТАП 2: AI ВЫБИРАЕТ ТРЕКИ ИЗ ЛИСТА ---
+        stage2_cache_key = ('stage2', snapshot.version, selected_sheet_name, lang_code, normalize_request(user_request))
+        cached_block = RESPONSE_CACHE.choose_variant(stage2_cache_key, RESPONSE_CACHE_VARIANTS)
+        if cached_block and selected_sheet_name in snapshot.stores:
+            # Повторный запрос: треки из кэша, в подводку подставляем имя этого слушателя
+            return serialize_response(ready_block_response(snapshot, snapshot.stores[selected_sheet_name], cached_block,
+                                                          user_name, user_request, lang_code, routing, cached=True))
+
+        if routing["path"] == "local" or llm_load() >= BLOCK_POOL_PRESSURE_LOAD:
+            # Настроение однозначно узнано локально или Gemini перегружен — отдаём готовый блок
+            # выбранного плейлиста, если он есть: частые настроения обходятся без обоих этапов
+            pooled_block = BLOCK_POOL.take(snapshot, selected_sheet_name, lang_code)
+            if pooled_block:
+                return serialize_response(ready_block_response(snapshot, snapshot.stores[selected_sheet_name], pooled_block,
+                                                              user_name, user_request, lang_code, routing, pooled=True))
+
+        # Промпт общий для всех слушателей с тем же запросом: имя подставляется в подводку после генерации
+        track_store, prompt_stage2 = prepare_stage2(snapshot, selected_sheet_name, user_request, LISTENER_NAME_PLACEHOLDER, lang_code)
+    except RadioPlayError as e:
+        return jsonify({"error": e.message}), e.status
+
+    raw_text = ""
+    try:
+        log_prompt(f"Промпт для Этапа 2 (плейлист: {selected_sheet_name}, язык: {lang_code})", prompt_stage2)
+        try:
+            raw_text = AI_FLIGHTS.do(
+                stage2_cache_key,
+                lambda: generate_stage2_text(stage2_cache_key, track_store, prompt_stage2),
+                timeout=STAGE2_TIMEOUT
+            )
+        except Exception as e:
+            logger.warning("Ошибка на 2-м этапе вызова AI: %s. Подбираю треки локально.", e)
+            return serialize_response(fallback_response(snapshot, track_store, selected_sheet_name, e,
+                                                        user_request, user_name, lang_code, routing))
+
+        return serialize_response(stage2_response(snapshot, track_store, selected_sheet_name, raw_text,
+                                                  user_request, user_name, lang_code, routing))
 
-    except json.JSONDecodeError as e:
-        print(f"ОШИБКА ДЕКОДИРОВАНИЯ JSON НА ЭТАПЕ 2: {e}\nОтвет от Gemini (ожидался JSON) был: '{raw_text}'")
-        return jsonify({"error": "Ошибка обработки ответа от AI. Не удалось разобрать JSON.", "raw_response": raw_text[:500] + "..."}), 500
     except Exception as e:
-        print(f"НЕПРЕДВИДЕННАЯ ОШИБКА НА ЭТАПЕ 2: {e}\nОтвет от Gemini (если был): '{raw_text}'")
+        logger.exception("НЕПРЕДВИДЕННАЯ ОШИБКА НА ЭТАПЕ 2: %s\nОтвет от Gemini (если был): '%.500s'", e, raw_text)
         return jsonify({"error": "Внутренняя ошибка сервера при обработке запроса AI."}), 500
 
+
+def format_sse(event, data):
+    """Одно событие Server-Sent Events с JSON-данными."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def stream_ready_block(response):
+    """SSE-события для уже готового ответа: все треки, подводка целиком и done."""
+    for track_details in response['playlist']:
+        yield format_sse('track', track_details)
+    yield format_sse('speech', {"text": response['speechText']})
+    yield format_sse('done', response)
+
+@app.route('/get-radio-play-stream', methods=['POST'])
+def get_radio_play_stream():
+    """Потоковый вариант /get-radio-play (SSE): события sheet, track, speech, done или error.
+    Треки отправляются по мере того, как Gemini генерирует их ID, чтобы клиент мог сразу начать воспроизведение."""
+    try:
+        snapshot = get_radio_snapshot()
+        user_request, user_name, lang_code = parse_radio_request()
+    except RadioPlayError as e:
+        return jsonify({"error": e.message}), e.status
+
+    def generate():
+        try:
+            yield from stream_events()
+        except Exception as e:
+            # Заголовки уже отправлены, поэтому 500 не вернуть — сообщаем об ошибке событием и закрываем поток
+            logger.exception("НЕПРЕДВИДЕННАЯ ОШИБКА В ПОТОКЕ: %s", e)
+            yield format_sse('error', {"error": "Внутренняя ошибка сервера при обработке запроса AI."})
+
+    def stream_events():
+        if is_default_request(user_request):
+            pooled_sheet_name, pooled_block = BLOCK_POOL.take_any(snapshot, lang_code)
+            if pooled_block:
+                routing = {"path": "pool", "confidence": 1.0}
+                yield format_sse('sheet', {"sheet": pooled_sheet_name, "routing": routing})
+                yield from stream_ready_block(ready_block_response(snapshot, snapshot.stores[pooled_sheet_name], pooled_block,
+                                                                             user_name, user_request, lang_code, routing, pooled=True))
+                return
+
+        try:
+            selected_sheet_name, routing = select_playlist(snapshot, user_request, lang_code)
+            yield format_sse('sheet', {"sheet": selected_sheet_name, "routing": routing})
+
+            stage2_cache_key = ('stage2', snapshot.version, selected_sheet_name, lang_code, normalize_request(user_request))
+            cached_block = RESPONSE_CACHE.choose_variant(stage2_cache_key, RESPONSE_CACHE_VARIANTS)
+            if cached_block and selected_sheet_name in snapshot.stores:
+                yield from stream_ready_block(ready_block_response(snapshot, snapshot.stores[selected_sheet_name], cached_block,
+                                                                             user_name, user_request, lang_code, routing, cached=True))
+                return
+            if routing["path"] == "local" or llm_load() >= BLOCK_POOL_PRESSURE_LOAD:
+                pooled_block = BLOCK_POOL.take(snapshot, selected_sheet_name, lang_code)
+                if pooled_block:
+                    yield from stream_ready_block(ready_block_response(snapshot, snapshot.stores[selected_sheet_name], pooled_block,
+                                                                                 user_name, user_request, lang_code, routing, pooled=True))
+                    return
+
+            # Промпт с заглушкой имени, как в /get-radio-play: готовый блок можно закэшировать для всех слушателей
+            track_store, prompt_stage2 = prepare_stage2(snapshot, selected_sheet_name, user_request, LISTENER_NAME_PLACEHOLDER, lang_code)
+        except RadioPlayError as e:
+            yield format_sse('error', {"error": e.message})
+            return
+
+        flight, is_leader = AI_FLIGHTS.join(stage2_cache_key)
+        if not is_leader:
+            # Такой же блок уже генерируется (потоком или обычным запросом) — ждём его и отдаём целиком
+            try:
+                raw_text = AI_FLIGHTS.wait(flight, STAGE2_TIMEOUT)
+            except Exception as e:
+                logger.warning("Ошибка на 2-м этапе (ожидание общего вызова): %s. Подбираю треки локально.", e)
+                yield from stream_ready_block(fallback_response(snapshot, track_store, selected_sheet_name, e,
+                                                                user_request, user_name, lang_code, routing))
+                return
+            yield from stream_ready_block(stage2_response(snapshot, track_store, selected_sheet_name, raw_text,
+                                                          user_request, user_name, lang_code, routing))
+            return
+
+        parser = StreamingBlockParser()
+        selected_positions = []
+        raw_text = ""
+        speech_tail = "" # Кусок подводки, который может быть началом заглушки имени
+        degraded = False
+        flight_error = UpstreamTimeout("ведущий потоковый запрос прерван") # Что получат ждущие, если поток оборвётся
+        details = track_store.details(lang_code)
+        try:
+            log_prompt(f"Промпт для Этапа 2, поток (плейлист: {selected_sheet_name}, язык: {lang_code})", prompt_stage2)
+            for chunk in stream_with_deadline(prompt_stage2, STAGE2_TIMEOUT, 'stage2', STAGE2_RESPONSE_CONFIG):
+                chunk_text = chunk.text or ""
+                raw_text += chunk_text
+                for event, value in parser.feed(chunk_text):
+                    if event == 'track':
+                        if resolve_track(track_store, value, lang_code):
+                            selected_positions.append(track_store.find_index(value))
+                            yield format_sse('track', details[selected_positions[-1]])
+                    elif event == 'speech':
+                        ready_text, speech_tail = split_placeholder_tail(speech_tail + value)
+                        if ready_text:
+                            yield format_sse('speech', {"text": personalize_speech(ready_text, user_name)})
+            remember_stage2_block(stage2_cache_key, track_store, parser.speech_text, list(selected_positions), parser.done)
+            flight_error = None
+            AI_FLIGHTS.finish(stage2_cache_key, flight, result=raw_text)
+        except Exception as e:
+            logger.warning("Ошибка на 2-м этапе (поток): %s. Недостающие треки подбираю локально.", e)
+            logger.debug("Ответ от Gemini (если был): '%.500s'", raw_text)
+            degraded = True
+            flight_error = None
+            AI_FLIGHTS.finish(stage2_cache_key, flight, error=e)
+            FALLBACKS.inc(stage='stage2', reason='timeout' if isinstance(e, UpstreamTimeout) else 'error')
+        finally:
+            if flight_error is not None:
+                # Клиент ведущего отключился посреди генерации — не оставляем ждущих до таймаута
+                AI_FLIGHTS.finish(stage2_cache_key, flight, error=flight_error)
+        if speech_tail:
+            yield format_sse('speech', {"text": personalize_speech(speech_tail, user_name)})
+
+        # Недостающие треки и пустую подводку добираем локально. Уже отправленную подводку не отозвать,
+        # поэтому оборванный текст остаётся как есть
+        streamed_count = len(selected_positions)
+        selected_positions, speech_text, repaired = repair_block(
+            track_store, selected_sheet_name, user_request, user_name, lang_code,
+            selected_positions, parser.speech_text, complete=True)
+        for position in selected_positions[streamed_count:]:
+            yield format_sse('track', details[position])
+        if not parser.speech_text:
+            yield format_sse('speech', {"text": speech_text})
+
+        if degraded:
+            BLOCKS_SERVED.inc(source='fallback')
+        elif repaired or not parser.done:
+            if not parser.done:
+                UPSTREAM_ERRORS.inc(upstream='gemini', stage='stage2', kind='bad_json')
+            FALLBACKS.inc(stage='stage2', reason='repaired')
+            BLOCKS_SERVED.inc(source='repaired')
+            repaired = True
+        else:
+            BLOCKS_SERVED.inc(source='llm')
+        done_event = {
+            "speechText": personalize_speech(speech_text, user_name),
+            "playlist": [details[position] for position in selected_positions],
+            "routing": routing,
+            "degraded": degraded,
+            **full_playlist_fields(snapshot, track_store, lang_code)
+        }
+        if repaired and not degraded:
+            done_event["repaired"] = True
+        yield format_sse('done', done_event)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# --- Фоновые задачи ---
+start_library() # Локальный снимок сразу, Google Sheets — по возможности в фоне
+start_block_pool_worker()
+
 # --- Запуск сервера ---
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5001))
@@ -0,0 +1,356 @@
+"""Офлайн-бенчмарки и нагрузочный тест AI Радио без Google Sheets и Gemini.
+
+Вместо gspread и genai подставляются локальные заглушки: синтетическая библиотека нужного размера
+и «модель» с настраиваемой задержкой, отвечающая правдоподобным JSON в блоке ```json.
+
+Примеры:
+    python benchmark.py micro --tracks 100 1000 10000 50000
+    python benchmark.py load --tracks 5000 --sheets 4 --concurrency 16 --requests 400 --llm-latency 0.3
+    python benchmark.py load --tracks 5000 --no-cache --llm-latency 0.3
+    python benchmark.py load --url http://localhost:5001 --concurrency 8 --requests 100
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# Бенчмарк не должен трогать локальный снимок библиотеки и запускать фоновую генерацию блоков
+os.environ.setdefault('LIBRARY_SNAPSHOT_PATH', '')
+os.environ.setdefault('BLOCK_POOL_SIZE', '0')
+os.environ.setdefault('LIBRARY_REFRESH_INTERVAL', '0')
+
+GENRES = ['rock', 'jazz', 'pop', 'ambient', 'electronic', 'classical', 'hip-hop', 'folk', 'blues', 'lounge']
+MOODS = ['calm', 'energetic', 'sad', 'happy', 'dreamy', 'dark', 'romantic', '']
+WORDS = {
+    'ru': ['спокойный', 'энергичный', 'вечерний', 'утренний', 'танцевальный', 'грустный', 'летний', 'дорога', 'дождь', 'ночь'],
+    'en': ['calm', 'energetic', 'evening', 'morning', 'dance', 'sad', 'summer', 'road', 'rain', 'night'],
+    'uk': ['спокійний', 'енергійний', 'вечірній', 'ранковий', 'танцювальний', 'сумний', 'літній', 'дорога', 'дощ', 'ніч'],
+}
+REQUESTS = ['удиви меня', 'relax', 'rock', 'что-нибудь спокойное на вечер', 'energetic morning run',
+            'джаз под дождь', 'танцевальная музыка', 'сумна музика', 'lounge for work', '']
+
+
+# --- Заглушки Google Sheets ---
+class FakeWorksheet:
+    def __init__(self, title, records):
+        self.title = title
+        self._records = records
+
+    def get_all_records(self):
+        return [dict(record) for record in self._records]
+
+
+class FakeSpreadsheet:
+    """Таблица с мета-листом и несколькими листами синтетических треков."""
+
+    def __init__(self, tracks_per_sheet, sheet_count, seed=42):
+        rng = random.Random(seed)
+        metadata = []
+        self._worksheets = []
+        for sheet_index in range(sheet_count):
+            genre = GENRES[sheet_index % len(GENRES)]
+            sheet_name = f"{genre.title()} Mix {sheet_index + 1}"
+            metadata.append({
+                'SheetName': sheet_name,
+                'DescriptionRU': f"Подборка: {genre}, {' '.join(rng.sample(WORDS['ru'], 3))}",
+                'DescriptionEN': f"Selection: {genre}, {' '.join(rng.sample(WORDS['en'], 3))}",
+                'DescriptionUK': f"Добірка: {genre}, {' '.join(rng.sample(WORDS['uk'], 3))}",
+                'TagsRU': ", ".join(rng.sample(WORDS['ru'], 4)),
+                'TagsEN': ", ".join([genre] + rng.sample(WORDS['en'], 3)),
+                'TagsUK': ", ".join(rng.sample(WORDS['uk'], 4)),
+            })
+            records = []
+            for track_index in range(tracks_per_sheet):
+                record = {
+                    'id': f"{sheet_index + 1}-{track_index + 1}",
+                    'title': f"Track {track_index + 1} {rng.choice(WORDS['en']).title()}",
+                    'artist': f"Artist {rng.randint(1, max(5, tracks_per_sheet // 8))}",
+                    'genre': genre if rng.random() < 0.7 else rng.choice(GENRES),
+                    'mood': rng.choice(MOODS),
+                    'music_url': f"https://example.com/music/{sheet_index + 1}/{track_index + 1}.mp3",
+                }
+                for lang_code, words in WORDS.items():
+                    record[f'description_{lang_code}'] = " ".join(rng.sample(words, 4))
+                    record[f'tags_{lang_code}'] = ", ".join(rng.sample(words, 3))
+                records.append(record)
+            self._worksheets.append(FakeWorksheet(sheet_name, records))
+        self._worksheets.insert(0, FakeWorksheet('_PlaylistMetadata', metadata))
+
+    def worksheet(self, title):
+        for worksheet in self._worksheets:
+            if worksheet.title == title:
+                return worksheet
+        import gspread
+        raise gspread.exceptions.WorksheetNotFound(title)
+
+    def worksheets(self):
+        return list(self._worksheets)
+
+
+# --- Заглушка Gemini ---
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+        self.usage_metadata = None
+
+
+class FakeModels:
+    """Отвечает как Gemini: на этапе 1 — названием листа, на этапе 2 — JSON в ```json с ID из промпта."""
+
+    def __init__(self, latency, jitter, fenced_share):
+        self.latency = latency
+        self.jitter = jitter
+        self.fenced_share = fenced_share
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _sleep(self):
+        time.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+
+    def _answer(self, prompt):
+        with self._lock:
+            self.calls += 1
+        if 'ID: ' not in prompt:
+            names = re.findall(r"(?:Название плейлиста|Playlist Name|Назва плейлисту)?: '([^']+)'", prompt)
+            return f"'{random.choice(names)}'" if names else "Unknown"
+        track_ids = re.findall(r"^ID: ([^,]+),", prompt, flags=re.MULTILINE)
+        payload = json.dumps({
+            "playlist": random.sample(track_ids, min(10, len(track_ids))),
+            "speechText": "Привет, [[NAME]]! Это подборка по запросу \"[[REQUEST]]\". Поехали!"
+        }, ensure_ascii=False, indent=2)
+        if random.random() < self.fenced_share:
+            return f"Вот подборка:\n```json\n{payload}\n```"
+        return payload
+
+    def generate_content(self, model, contents, config=None):
+        self._sleep()
+        return FakeResponse(self._answer(contents))
+
+    def generate_content_stream(self, model, contents, config=None):
+        text = self._answer(contents)
+        self._sleep()
+        for start in range(0, len(text), 24):
+            time.sleep(0.002)
+            yield FakeResponse(text[start:start + 24])
+
+
+class FakeGenaiClient:
+    def __init__(self, latency=0.2, jitter=0.05, fenced_share=0.5):
+        self.models = FakeModels(latency, jitter, fenced_share)
+
+
+def load_app(tracks_per_sheet, sheet_count, llm_latency=0.2, verbose=False):
+    """Импортирует app с заглушками вместо Google Sheets и Gemini и загружает синтетическую библиотеку."""
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        import app
+        app.sh = FakeSpreadsheet(tracks_per_sheet, sheet_count)
+        app.client = FakeGenaiClient(latency=llm_latency)
+        app.refresh_library()
+    return app
+
+
+# --- Статистика ---
+def percentile(sorted_values, share):
+    if not sorted_values:
+        return 0.0
+    position = min(len(sorted_values) - 1, max(0, int(round(share * (len(sorted_values) - 1)))))
+    return sorted_values[position]
+
+def describe(latencies):
+    values = sorted(latencies)
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(values, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+        "mean_ms": round(statistics.fmean(values) * 1000, 2) if values else 0.0,
+    }
+
+def measure(function, repeat):
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - started)
+    return describe(latencies)
+
+
+# --- Микробенчмарки ---
+def run_micro(args):
+    for tracks in args.tracks:
+        app = load_app(tracks, 1, verbose=args.verbose)
+        snapshot = app.LIBRARY_SNAPSHOT
+        track_store = next(iter(snapshot.stores.values()))
+        records = track_store.tracks
+        ai_ids = [record['id'] for record in random.sample(records, min(10, len(records)))]
+
+        def linear_resolution():
+            # Как было до индекса: линейный поиск по каждому ID
+            for track_id in ai_ids:
+                next((t for t in records if str(t.get('id')).strip() == track_id), None)
+
+        results = {
+            "format_tracks_for_ai": measure(lambda: app.format_tracks_for_ai(records, 'ru'), args.repeat),
+            "get_track_details_for_playlist": measure(
+                lambda: [app.get_track_details_for_playlist(record, 'en') for record in records], args.repeat),
+            "id_resolution_index": measure(lambda: [track_store.find_index(track_id) for track_id in ai_ids], args.repeat),
+            "id_resolution_linear": measure(linear_resolution, args.repeat),
+            "select_candidates": measure(
+                lambda: track_store.select_candidates('спокойный вечерний jazz', app.STAGE2_MAX_CANDIDATES), args.repeat),
+            "route_stage1": measure(lambda: snapshot.router.route('энергичный рок на утро'), args.repeat),
+        }
+        print(json.dumps({"tracks": tracks, "results": results}, ensure_ascii=False, indent=2))
+
+
+# --- Нагрузочный тест ---
+def _local_caller(app):
+    def call(method, path, body=None):
+        client = app.app.test_client() # Свой тестовый клиент на каждый запрос: общий не потокобезопасен
+        if method == 'GET':
+            response = client.get(path)
+        else:
+            response = client.post(path, json=body)
+        return response.status_code, response.get_data(as_text=True)
+
+    return call
+
+def _http_caller(base_url, timeout):
+    def call(method, path, body=None):
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        http_request = urllib.request.Request(base_url.rstrip('/') + path, data=data, method=method,
+                                              headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(http_request, timeout=timeout) as response:
+                return response.status, response.read().decode('utf-8', 'replace')
+        except urllib.error.HTTPError as e:
+            return e.code, ""
+
+    return call
+
+def block_source(body):
+    """Откуда взят блок в ответе /get-radio-play*: cached, pooled, generated (Gemini или запасной вариант) или error."""
+    if 'event: done' in body:
+        body = body.split('event: done\ndata: ', 1)[1].split('\n', 1)[0]
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return 'error'
+    if not isinstance(data, dict) or 'error' in data:
+        return 'error'
+    if data.get('cached'):
+        return 'cached'
+    if data.get('pooled'):
+        return 'pooled'
+    return 'generated'
+
+def run_load(args):
+    if args.url:
+        call = _http_caller(args.url, args.timeout)
+        app = None
+    else:
+        if args.no_cache:
+            # Кэши задаются при импорте app, поэтому выключаем их до загрузки
+            os.environ['RESPONSE_CACHE_TTL'] = '0'
+            os.environ['PROMPT_CACHE_MAX_ENTRIES'] = '0'
+        app = load_app(args.tracks[0], args.sheets, llm_latency=args.llm_latency, verbose=args.verbose)
+        call = _local_caller(app)
+
+    def radio_request():
+        user_request = random.choice(REQUESTS)
+        if args.no_cache and args.url:
+            # Кэш удалённого сервера не выключить, поэтому делаем каждый запрос уникальным
+            user_request = f"{user_request} {random.randint(0, 10 ** 9)}".strip()
+        return user_request
+
+    endpoints = {
+        '/get-full-playlist': lambda: call('GET', f"/get-full-playlist?language={random.choice(['ru', 'en', 'uk'])}"),
+        '/get-radio-play': lambda: call('POST', '/get-radio-play', {
+            'request': radio_request(), 'userName': f"Listener {random.randint(1, 1000)}",
+            'language': random.choice(['ru', 'en', 'uk'])}),
+        '/get-radio-play-stream': lambda: call('POST', '/get-radio-play-stream', {
+            'request': radio_request(), 'userName': 'Listener', 'language': 'ru'}),
+    }
+    selected = [name for name in endpoints if not args.endpoints or name in args.endpoints]
+
+    for endpoint in selected:
+        latencies = []
+        latencies_by_source = {}
+        statuses = {}
+        lock = threading.Lock()
+
+        def one_request(_):
+            started = time.perf_counter()
+            status, body = endpoints[endpoint]()
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+                if endpoint != '/get-full-playlist':
+                    latencies_by_source.setdefault(block_source(body), []).append(elapsed)
+
+        # Вывод app.py глушим целиком на время прогона: redirect_stdout в каждом потоке не потокобезопасен
+        output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+        llm_calls_before = app.client.models.calls if app is not None else 0
+        started = time.perf_counter()
+        with output, ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            list(executor.map(one_request, range(args.requests)))
+        wall_time = time.perf_counter() - started
+
+        report = describe(latencies)
+        report.update({
+            "endpoint": endpoint,
+            "concurrency": args.concurrency,
+            "throughput_rps": round(len(latencies) / wall_time, 2) if wall_time else 0.0,
+            "statuses": statuses,
+            "no_cache": args.no_cache,
+        })
+        if latencies_by_source:
+            # Попадания в кэш на порядки быстрее генерации, поэтому общие перцентили их смешивают
+            report["by_source"] = {source: describe(values) for source, values in sorted(latencies_by_source.items())}
+        if app is not None:
+            report["llm_calls"] = app.client.models.calls - llm_calls_before
+        print(json.dumps(report, ensure_ascii=False))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    micro = subparsers.add_parser('micro', help='микробенчмарки форматирования, деталей треков и поиска по ID')
+    micro.add_argument('--tracks', type=int, nargs='+', default=[100, 1000, 10000, 50000], help='размеры библиотеки')
+    micro.add_argument('--repeat', type=int, default=20, help='повторов каждого замера')
+
+    load = subparsers.add_parser('load', help='параллельная нагрузка на эндпоинты с отчётом p50/p95/p99')
+    load.add_argument('--tracks', type=int, nargs=1, default=[2000], help='треков на лист')
+    load.add_argument('--sheets', type=int, default=4, help='листов с треками')
+    load.add_argument('--concurrency', type=int, default=8, help='одновременных запросов')
+    load.add_argument('--requests', type=int, default=200, help='запросов на эндпоинт')
+    load.add_argument('--llm-latency', type=float, default=0.2, help='средняя задержка заглушки Gemini, сек')
+    load.add_argument('--endpoints', nargs='*', help='какие эндпоинты нагружать (по умолчанию все)')
+    load.add_argument('--url', help='нагружать запущенный сервер по HTTP вместо заглушек в процессе')
+    load.add_argument('--timeout', type=float, default=60, help='таймаут HTTP-запроса при --url, сек')
+    load.add_argument('--no-cache', action='store_true',
+                      help='мерить конвейер этапов 1 и 2 без кэша ответов и фрагментов промптов (при --url — уникальные запросы)')
+
+    for subparser in (micro, load):
+        subparser.add_argument('--verbose', action='store_true', help='не глушить вывод app.py')
+
+    args = parser.parse_args(argv)
+    if args.command == 'micro':
+        run_micro(args)
+    else:
+        run_load(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
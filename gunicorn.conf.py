@@ -0,0 +1,17 @@
+# Конфигурация gunicorn для продакшена (Render): gunicorn -c gunicorn.conf.py app:app
+# Потоковые воркеры (gthread): запрос, ждущий Gemini, занимает только свой поток, а не весь процесс.
+# Количество одновременных вызовов Gemini дополнительно ограничено LLM_MAX_CONCURRENCY в app.py.
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5001')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', '2'))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', '16'))
+
+# Дедлайны этапов в app.py короче, так что этот таймаут срабатывает только при зависании воркера
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '90'))
+graceful_timeout = 30
+keepalive = 5
+
+# Не используем preload_app: фоновое обновление библиотеки запускается в каждом воркере отдельно
+preload_app = False
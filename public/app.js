@@ -11,7 +11,9 @@ document.addEventListener('DOMContentLoaded', () => {
 
     // --- URLы бэкенда ---
     const aiBackendUrl = 'https://radio-2gyc.onrender.com/get-radio-play';
+    const aiStreamBackendUrl = 'https://radio-2gyc.onrender.com/get-radio-play-stream';
     const libraryBackendUrl = 'https://radio-2gyc.onrender.com/get-full-playlist';
+    const backendBaseUrl = 'https://radio-2gyc.onrender.com'; // Относительные musicUrl (/audio/...) отдаёт бэкенд
 
     // --- Переменные для управления состоянием радио ---
     let fullLibrary = [];
@@ -19,7 +21,9 @@ document.addEventListener('DOMContentLoaded', () => {
     let currentTrackIndex = 0;
     let isAiMode = false;
 
-    // --- Функции fetchFullLibrary и fetchAiPlaylist (без изменений) ---
+    // --- Функции fetchFullLibrary и fetchAiPlaylist ---
+    // Библиотеку браузер кэширует сам: сервер отдаёт ETag, повторная загрузка без изменений получает 304.
+    // Весь лист в ответах AI не нужен (fullPlaylist: false), приходит только версия библиотеки.
     async function fetchFullLibrary() {
         try {
             const response = await fetch(libraryBackendUrl);
@@ -37,7 +41,7 @@ document.addEventListener('DOMContentLoaded', () => {
             const response = await fetch(aiBackendUrl, {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ request: userRequest, userName: "Слушатель" }),
+                body: JSON.stringify({ request: userRequest, userName: "Слушатель", fullPlaylist: false }),
             });
             if (!response.ok) {
                 const errorData = await response.json();
@@ -50,6 +54,50 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    // --- Потоковый запрос к AI (Server-Sent Events поверх fetch) ---
+    // handlers: onSheet(data), onTrack(track), onSpeech(textChunk); возвращает итоговое событие done
+    async function fetchAiPlaylistStream(userRequest, handlers) {
+        const response = await fetch(aiStreamBackendUrl, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json', 'Accept': 'text/event-stream' },
+            body: JSON.stringify({ request: userRequest, userName: "Слушатель", fullPlaylist: false }),
+        });
+        if (!response.ok || !response.body) {
+            const errorData = await response.json().catch(() => ({}));
+            throw new Error(errorData.error || `Ошибка сервера: ${response.status}`);
+        }
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            let separatorIndex;
+            while ((separatorIndex = buffer.indexOf('\n\n')) !== -1) {
+                const rawEvent = buffer.slice(0, separatorIndex);
+                buffer = buffer.slice(separatorIndex + 2);
+
+                let eventName = 'message';
+                let dataText = '';
+                for (const line of rawEvent.split('\n')) {
+                    if (line.startsWith('event: ')) eventName = line.slice(7);
+                    else if (line.startsWith('data: ')) dataText += line.slice(6);
+                }
+                const data = dataText ? JSON.parse(dataText) : {};
+
+                if (eventName === 'sheet' && handlers.onSheet) handlers.onSheet(data);
+                else if (eventName === 'track' && handlers.onTrack) handlers.onTrack(data);
+                else if (eventName === 'speech' && handlers.onSpeech) handlers.onSpeech(data.text);
+                else if (eventName === 'error') throw new Error(data.error);
+                else if (eventName === 'done') return data;
+            }
+        }
+        throw new Error('Поток прервался до завершения подборки.');
+    }
+
     // --- Функция setButtonLoading (без изменений) ---
     function setButtonLoading(isLoading) {
         playButton.disabled = isLoading;
@@ -82,7 +130,7 @@ document.addEventListener('DOMContentLoaded', () => {
             trackInfoElement.textContent = `${trackToPlay.artist} - ${trackToPlay.title}`;
             // ПОКАЗЫВАЕМ ВЕСЬ БЛОК
             nowPlayingContainer.style.display = 'block';
-            audioPlayer.src = trackToPlay.musicUrl;
+            audioPlayer.src = new URL(trackToPlay.musicUrl, backendBaseUrl).href;
             audioPlayer.play();
         } else {
             // Музыки нет, скрываем блок
@@ -102,7 +150,39 @@ document.addEventListener('DOMContentLoaded', () => {
         nowPlayingContainer.style.display = 'none'; // Скрываем старый трек
         audioPlayer.pause(); 
 
-        const data = await fetchAiPlaylist(userRequest);
+        // Треки приходят по одному: первый запускаем сразу, остальные добавляем в очередь
+        currentAiPlaylist = [];
+        currentTrackIndex = 0;
+        let speechStarted = false;
+        let data;
+        try {
+            data = await fetchAiPlaylistStream(userRequest, {
+                onTrack: (track) => {
+                    currentAiPlaylist.push(track);
+                    if (currentAiPlaylist.length === 1) {
+                        isAiMode = true;
+                        setButtonLoading(false);
+                        playNextTrack();
+                    }
+                },
+                onSpeech: (textChunk) => {
+                    if (!speechStarted) {
+                        speechStarted = true;
+                        speechTextElement.textContent = '';
+                    }
+                    speechTextElement.textContent += textChunk;
+                },
+            });
+        } catch (error) {
+            console.error('Ошибка потокового запроса:', error);
+            if (currentAiPlaylist.length > 0) {
+                // Что-то уже играет — оставляем полученные треки
+                setButtonLoading(false);
+                return;
+            }
+            // Фоллбэк на обычный запрос
+            data = await fetchAiPlaylist(userRequest);
+        }
         setButtonLoading(false);
 
         if (data.error) {
@@ -113,6 +193,10 @@ document.addEventListener('DOMContentLoaded', () => {
         // ПОМЕЩАЕМ РЕЧЬ ДИДЖЕЯ В ЕГО ПОЛЕ
         speechTextElement.textContent = data.speechText || "К сожалению, не удалось найти подходящие треки.";
 
+        if (currentAiPlaylist.length > 0) {
+            // Воспроизведение уже идёт с первого пришедшего трека
+            return;
+        }
         if (data.playlist && data.playlist.length > 0) {
             // Успех! Готовимся к запуску AI-плейлиста
             currentAiPlaylist = data.playlist;